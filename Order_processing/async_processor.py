@@ -0,0 +1,205 @@
+import os
+import sys
+import asyncio
+import inspect
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import order_processing_logic  # Import the order processing logic module
+import state_store
+import metrics
+from order_record import OrderRecord
+from batch_processor import read_order_ids, parking_lot
+from retry_policy import RetryPolicies, StepLimiter
+from step_executor import StepExecutor, StepTimeout
+from checkpoint import CheckpointPolicy, exit_on_signals
+
+log = metrics.get_logger("async_processor")
+
+async def call_step(process_step, step, timeout, executor):
+    """Await a coroutine step function under a deadline, or run a blocking one on the executor.
+
+    A coroutine is cancelled at its deadline. A blocking function can't be,
+    so it runs on one of the executor's workers, which is recycled if the
+    step hangs; the thread waiting on it here is released at the deadline.
+    With isolation "none" it runs on asyncio's own threads, and only the
+    wait is cut short: a hung step keeps its thread until it returns.
+    """
+    if inspect.iscoroutinefunction(process_step):
+        try:
+            return await asyncio.wait_for(process_step(step), timeout)
+        except asyncio.TimeoutError:
+            raise StepTimeout(f"Step {step} timed out after {timeout}s.")
+    call = asyncio.to_thread(executor.run, process_step, step, timeout)
+    if executor.isolation != "none":
+        return await call  # The executor enforces the deadline
+    try:
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        metrics.registry.counter("step_timeouts_total", step=step).inc()
+        raise StepTimeout(f"Step {step} timed out after {timeout}s.")
+
+class AsyncOrderProcessing:
+    """Drive many orders concurrently on one event loop.
+
+    Steps of a single order still run in sequence; concurrency comes from
+    running up to `concurrency` orders' steps at the same time. Retry
+    backoff is an asyncio.sleep, so a waiting order never holds a slot.
+
+    Without a process_step, the steps, their timeouts and retry policies come
+    from order_processing_logic's step registry, and so do the steps' rate
+    limits: an order waits for its step's concurrency slot and rate token
+    before it takes one of the `concurrency` slots. A process_step of its own
+    comes with max_steps, the number of steps it runs.
+
+    With a shared store (.mmap), an order is locked for as long as this
+    process runs it, so several processes can work through one store; an
+    order another process holds is left to it.
+
+    State is committed per the checkpoint policy (see common/checkpoint.py);
+    by default once 256 transitions are pending, and always on shutdown.
+    """
+
+    def __init__(self, process_step=None, concurrency=100, step_timeout=30.0, state_file="async_state.pkl",
+                 retry_policies=None, isolation="thread", max_steps=None, checkpoint="256"):
+        if process_step and not max_steps:
+            raise ValueError("Pass max_steps with a process_step; only the step registry knows its own length")
+        self.registry = None if process_step else order_processing_logic.registry
+        self.process_step = process_step or order_processing_logic.process_step
+        self.max_steps = max_steps if process_step else self.registry.max_steps
+        self.store = state_store.open_store(state_file, group_size=256, max_steps=self.max_steps)
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, self.store)
+        self.orders = self.store.load_unfinished(self.max_steps)  # Finished orders stay in the store
+        per_step = self.registry.retry_policies() if self.registry else None
+        self.retry_policies = retry_policies or RetryPolicies(per_step=per_step)
+        self.limiter = StepLimiter(self.registry.rate_limits() if self.registry else {})
+        self.waiting = {}  # step -> orders waiting on its rate limit
+        self.concurrency = concurrency
+        self.step_timeout = step_timeout
+        self.executor = StepExecutor(min(concurrency, 32), isolation)  # asyncio.to_thread uses at most 32 threads
+
+    def add_order(self, order_id):
+        """Queue an order; orders already known keep their saved progress."""
+        if order_id not in self.orders:
+            self.orders[order_id] = self.store.setdefault(order_id, OrderRecord())  # Another process may have added it
+
+    async def admit(self, step):
+        """Wait until the step's rate limit admits one more call."""
+        delay = self.limiter.try_acquire(step)
+        if not delay:
+            return
+        self.waiting[step] = self.waiting.get(step, 0) + 1
+        self.limiter.queued(step, self.waiting[step])
+        try:
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self.limiter.try_acquire(step)
+        finally:
+            self.waiting[step] -= 1
+            self.limiter.queued(step, self.waiting[step])
+
+    async def run_order(self, order_id, limit):
+        if not self.store.lock(order_id, blocking=False):
+            return  # Another process is running it
+        try:
+            if self.store.shared:
+                self.orders[order_id] = self.store.load(order_id) or self.orders[order_id]  # Its latest progress
+            if parking_lot.resume(self.orders[order_id]):
+                self.checkpoint.save(self.orders[order_id], order_id)  # Released by an operator; retries start afresh
+            await self.run_steps(order_id, limit)
+        finally:
+            self.store.unlock(order_id)
+
+    async def run_steps(self, order_id, limit):
+        state = self.orders[order_id]
+        while state["step"] <= self.max_steps:
+            step = state["step"]
+            breaker = self.retry_policies.breaker_for(step)
+            timeout = self.registry.timeout_for(step, self.step_timeout) if self.registry else self.step_timeout
+            if not breaker.allow():
+                await asyncio.sleep(breaker.remaining() or 0.05)
+                continue
+            try:
+                await self.admit(step)
+                try:
+                    async with limit:  # Only the step itself holds a concurrency slot
+                        success = await call_step(self.process_step, step, timeout, self.executor)
+                finally:
+                    self.limiter.release(step)
+                if success:
+                    breaker.record_success()
+                    state["step"] += 1
+                    state["retry_count"] = 0
+                    self.checkpoint.save(state, order_id)
+                    continue
+                raise Exception(f"Step {step} failed.")
+            except StepTimeout as e:
+                error = e
+                log.warning(f"Order {order_id}: {error}")
+            except Exception as e:
+                error = e
+                log.warning(f"Order {order_id}: Error at Step {step}: {e}")
+
+            breaker.record_failure()
+            state["retry_count"] += 1
+            if state["retry_count"] > self.retry_policies.policy_for(step).max_retries:
+                log.error(f"Order {order_id}: Maximum retries reached for Step {step}. Parking the order.")
+                parking_lot.park(order_id, step, error, state)  # Saved with the retry_count it failed at
+                self.checkpoint.save(state, order_id)
+                self.checkpoint.flush()
+                return
+            self.checkpoint.save(state, order_id)
+            await asyncio.sleep(self.retry_policies.retry_delay(step, state["retry_count"]))
+
+    async def run(self, order_ids=()):
+        for order_id in order_ids:
+            self.add_order(order_id)
+
+        limit = asyncio.Semaphore(self.concurrency)
+        parked = parking_lot.parked()
+        pending = [order_id for order_id, state in self.orders.items()
+                   if state["step"] <= self.max_steps and order_id not in parked]
+        try:
+            await asyncio.gather(*(self.run_order(order_id, limit) for order_id in pending))
+        finally:
+            self.executor.close()
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+        log.info(f"Async processing completed for {len(self.orders)} orders!")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process a stream of orders on one event loop.")
+    parser.add_argument("files", nargs="*", help="files of order IDs, one per line (default: stdin)")
+    parser.add_argument("--logic", choices=["order_processing", "task_logic"], default="order_processing",
+                        help="step implementation to drive")
+    parser.add_argument("--concurrency", type=int, default=100, help="maximum steps in flight")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="per-step timeout in seconds, for steps that don't declare their own")
+    parser.add_argument("--store", default="async_state.pkl", help="state file; .db/.sqlite uses SQLite, .mmap a memory-mapped file")
+    parser.add_argument("--checkpoint", default="256",
+                        help="when to commit state: every N transitions (default 256), step, Tms, exit, or e.g. 256,250ms")
+    parser.add_argument("--isolation", choices=["thread", "process", "none"], default="thread",
+                        help="where blocking steps run: a recyclable thread (default), a child process, or asyncio's "
+                             "threads, where a step that times out is abandoned but keeps its thread")
+    args = parser.parse_args()
+
+    if args.logic == "task_logic":
+        import task_logic
+        process_step, max_steps = task_logic.TaskLogic.run_step_async, task_logic.TaskLogic.MAX_STEPS
+    else:
+        process_step, max_steps = None, None  # order_processing_logic's step registry
+
+    if args.files:
+        order_ids = []
+        for path in args.files:
+            with open(path) as f:
+                order_ids.extend(read_order_ids(f))
+    else:
+        order_ids = list(read_order_ids(sys.stdin))
+
+    exit_on_signals()
+    order_processor = AsyncOrderProcessing(process_step, args.concurrency, args.timeout, args.store,
+                                           isolation=args.isolation, max_steps=max_steps, checkpoint=args.checkpoint)
+    try:
+        asyncio.run(order_processor.run(order_ids))
+    finally:
+        order_processor.checkpoint.close()  # A signal can land outside run()'s own finally
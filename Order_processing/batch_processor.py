@@ -0,0 +1,424 @@
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import time
+import hot_reload
+import parking
+import metrics
+import pipeline
+from order_record import OrderRecord
+from retry_policy import RetryPolicies, StepLimiter, TimerWheel
+from checkpoint import CheckpointPolicy, exit_on_signals
+from step_executor import StepExecutor
+
+def read_order_ids(stream):
+    """Yield order IDs from a stream, one per line, skipping blank lines."""
+    for line in stream:
+        order_id = line.strip()
+        if order_id:
+            yield order_id
+
+logic_reloader = hot_reload.ModuleReloader("order_processing_logic")
+parking_lot = parking.ParkingLot()
+log = metrics.get_logger("batch_processor")
+
+class BatchOrderProcessing:
+    """Drive many orders through steps 1-5 in a single process.
+
+    Orders are scheduled from the registry's dependency graph. A step is
+    ready for an order once every step it depends on has completed (or
+    been skipped), and every pass runs each order's ready steps, grouped by
+    step number; independent steps, like two that only depend on the same
+    earlier one, run in the same pass. An order's "step" is its first step
+    that hasn't completed, and its completed_mask the steps that have.
+    Orders that run out of retries are parked (see common/parking.py) and
+    left alone until an operator releases them, so one bad order never
+    stalls the others.
+
+    A failed step is not retried in place: it is put on a timer wheel for
+    its backoff delay and skipped by later passes until it falls due, while
+    the order's other ready steps carry on. Failures are counted per step;
+    the record's retry_count keeps the highest count. Steps whose circuit
+    breaker is open are deferred the same way.
+
+    rerun names steps to run again for every order given: each is cleared
+    from the order's completed_mask with registry.invalidate(), along with
+    the steps downstream of it, except those registered with
+    revalidate=False, which keep their result.
+
+    State is committed per the checkpoint policy (see common/checkpoint.py); by
+    default at the end of every pass.
+
+    Steps run on a StepExecutor under their registry timeout (step_timeout
+    for steps without one); a step that times out is retried like any other
+    failure, and its hung worker is replaced.
+
+    Steps the logic module can run in bulk (registry.batchable()) get one
+    process_step_batch() call per batch_size orders, under the same
+    timeout, and each order's result is applied as if it had run alone.
+    With batch_wait > 0, a batch smaller than batch_size is held back on
+    the retry wheel for up to batch_wait seconds so later orders can join it.
+
+    Several engines can share a store whose shared flag is set (.mmap):
+    each claims an order with store.lock() before running a step for it and
+    releases it once the result is saved, and picks up the progress other
+    engines saved in the meantime. An order another engine holds is skipped
+    and looked at again on a later pass.
+
+    Steps with a RateLimit only run as fast as it allows. Orders the limit
+    holds back go on the retry wheel, spaced at the step's rate so they come
+    back about when tokens do, and don't count as retries. A bulk call
+    counts as one call.
+
+    With a pipeline (see pipeline.py), the steps, their dependencies, retry
+    policies and handlers come from its compiled plan instead of
+    order_processing_logic's registry; the handlers' module is hot-reloaded
+    the same way.
+    """
+
+    def __init__(self, order_ids=(), state_file="batch_state.pkl", retry_policies=None, checkpoint="pass",
+                 step_timeout=30.0, isolation="thread", batch_size=1000, batch_wait=0.0, pipeline=None, rerun=()):
+        if pipeline and isolation == "process":
+            raise ValueError("Pipeline steps can't run in a child process, which only sees a logic module's "
+                             "own process_step; use thread isolation")
+        self.logic_reloader = pipeline.reloader() if pipeline else logic_reloader
+        self.logic = self.logic_reloader.load()
+        self.max_steps = self.logic.registry.max_steps
+        self.store = state_store.open_store(state_file, group_size=256, max_steps=self.max_steps)
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, self.store)
+        self.step_timeout = step_timeout
+        self.executor = StepExecutor(isolation=isolation)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.batch_deadlines = {}  # step -> when the batch being held for it must run
+        self.orders = self.store.load_unfinished(self.max_steps)  # Finished orders stay in the store
+        self.order_versions = {}  # order_id -> logic version the order started on
+        self.retries = {}  # order_id -> {step: failures so far}, for orders with steps being retried
+        self.rerun = [self.logic.registry.number_of(step) for step in rerun]
+        if retry_policies is None:
+            retry_policies = pipeline.retry_policies() if pipeline else RetryPolicies(per_step=self.logic.registry.retry_policies())
+        self.retry_policies = retry_policies
+        self.limiter = StepLimiter(self.logic.registry.rate_limits())
+        self.retry_wheel = TimerWheel()
+        self.waiting = set()  # (order_id, step) pairs scheduled on the retry wheel
+        for order_id in order_ids:
+            self.add_order(order_id)
+
+    def add_order(self, order_id):
+        """Queue an order; orders already known keep their saved progress, less the steps to rerun."""
+        if order_id in self.orders:
+            state = self.orders[order_id]
+        else:
+            state = self.store.load(order_id)  # Retired orders are only in the store
+            if state is None and self.store.shared:
+                state = self.store.setdefault(order_id, OrderRecord())  # Another engine may be adding it too
+            elif state is None:
+                state = OrderRecord()
+                self.checkpoint.save(state, order_id)
+            self.orders[order_id] = state
+        if self.rerun:
+            self.rerun_steps(order_id, state)
+
+    def rerun_steps(self, order_id, state):
+        """Clear the steps to rerun, and the ones downstream of them that revalidate, from an order's progress."""
+        registry = self.logic.registry
+        before = self.done_mask(state)
+        completed, skipped = before & ~state["skipped_mask"], state["skipped_mask"]
+        for step in self.rerun:
+            completed = registry.invalidate(step, completed)
+            skipped = registry.invalidate(step, skipped)
+        state["completed_mask"], state["skipped_mask"] = completed, skipped
+        state["step"] = registry.first_pending(completed | skipped)
+        state["retry_count"] = 0
+        self.retries.pop(order_id, None)
+        self.checkpoint.save(state, order_id)
+        log.info(f"Order {order_id}: rerunning Steps {registry.steps_in(before & ~(completed | skipped))}.")
+
+    def retire(self):
+        """Drop finished and parked orders from memory; they stay in the store. Returns how many."""
+        parked = parking_lot.parked()
+        retired = [order_id for order_id, state in self.orders.items()
+                   if state["step"] > self.max_steps or order_id in parked]
+        for order_id in retired:
+            del self.orders[order_id]
+            self.order_versions.pop(order_id, None)
+            self.retries.pop(order_id, None)
+        return len(retired)
+
+    def reload_task_logic(self):
+        """Reload the logic module if its source changed."""
+        with metrics.registry.timer("logic_reload_seconds"):
+            self.logic = self.logic_reloader.load()
+
+    def logic_for(self, order_id):
+        """Return the logic module an order is pinned to, pinning it on first use."""
+        version = self.order_versions.get(order_id)
+        if version is None:
+            version, _ = self.logic_reloader.pin()
+            self.order_versions[order_id] = version
+        return self.logic_reloader.module_for(version)
+
+    def done_mask(self, state):
+        """Mask of an order's completed and skipped steps."""
+        mask = state["completed_mask"] | state["skipped_mask"]
+        return mask | self.logic.registry.bit(state["step"]) - 1  # Every step before "step" is done, as linear runners saved it
+
+    def is_ready(self, state, step):
+        done = self.done_mask(state)
+        return not done & self.logic.registry.bit(step) and not self.logic.registry.ancestors[step] & ~done
+
+    def pending_by_step(self):
+        """Group the IDs of unfinished, unparked orders by the steps ready to run for them."""
+        parked = parking_lot.parked()
+        ready = self.logic.registry.ready
+        groups = {}
+        for order_id, state in self.orders.items():
+            if state["step"] <= self.max_steps and order_id not in parked:
+                for step in ready(self.done_mask(state)):
+                    if (order_id, step) not in self.waiting:
+                        groups.setdefault(step, []).append(order_id)
+        return groups
+
+    def wait(self, order_id, step, delay):
+        """Take an order's step out of the passes until delay seconds have passed."""
+        self.waiting.add((order_id, step))
+        self.retry_wheel.schedule(delay, (order_id, step))
+
+    def retry_counts(self, order_id):
+        """Return {step: failures} for an order, starting from the retry_count an earlier run saved."""
+        counts = self.retries.get(order_id)
+        if counts is None:
+            state = self.orders[order_id]
+            counts = self.retries[order_id] = {state["step"]: state["retry_count"]} if state["retry_count"] else {}
+        return counts
+
+    def claim(self, step, order_id):
+        """Lock an order against other engines sharing the store, with their latest progress loaded.
+
+        Returns False if another engine holds the order, or has run step or
+        parked it; the order is then left alone, as it is once this engine
+        parked it earlier in the pass. A claimed order is released by
+        release() once its result is saved. An order an operator released
+        from the parking lot starts its retries afresh.
+        """
+        if self.store.shared:
+            if not self.store.lock(order_id, blocking=False):
+                self.wait(order_id, step, self.retry_wheel.tick)  # Busy in another engine; look again later
+                return False
+            state = self.store.load(order_id)
+            if state is not None:
+                self.orders[order_id] = state
+            if not self.is_ready(self.orders[order_id], step) or parking_lot.is_parked(order_id):
+                self.store.unlock(order_id)
+                return False
+        elif self.orders[order_id]["parked"] and parking_lot.is_parked(order_id):
+            return False  # Parked by another of its steps this pass
+        if parking_lot.resume(self.orders[order_id]):
+            self.retries.pop(order_id, None)
+            self.checkpoint.save(self.orders[order_id], order_id)
+        return True
+
+    def release(self, order_id):
+        self.store.unlock(order_id)
+
+    def throttle(self, step, order_ids, delay):
+        """Hold back orders the step's rate limit refused, spread out at its rate."""
+        interval = self.limiter.interval(step)
+        for position, order_id in enumerate(order_ids):
+            self.wait(order_id, step, delay + position * interval)
+
+    def record_result(self, step, order_id, result):
+        """Apply one order's result for a step: True, False or the exception it raised. Returns 1 on success."""
+        breaker = self.retry_policies.breaker_for(step)
+        registry = self.logic.registry
+        state = self.orders[order_id]
+        counts = self.retry_counts(order_id)
+        if result and not isinstance(result, Exception):
+            breaker.record_success()
+            state["completed_mask"] = self.done_mask(state) & ~state["skipped_mask"] | registry.bit(step)
+            self.advance_cursor(order_id, state, counts, step)
+            self.checkpoint.save(state, order_id)
+            if state["step"] > self.max_steps:
+                metrics.registry.counter("orders_completed_total").inc()
+            return 1
+
+        error = result if isinstance(result, Exception) else Exception(f"Step {step} failed.")
+        log.error(f"Order {order_id}: Error at Step {step}: {error}")
+        breaker.record_failure()
+        counts[step] = counts.get(step, 0) + 1
+        state["retry_count"] = max(counts.values())
+        metrics.registry.counter("step_retries_total", step=step).inc()
+
+        if counts[step] > self.retry_policies.policy_for(step).max_retries:
+            if registry.on_exhausted(step) == "skip":
+                log.warning(f"Order {order_id}: Maximum retries reached for Step {step}. Skipping the step.")
+                state["skipped_mask"] |= registry.bit(step)
+                self.advance_cursor(order_id, state, counts, step)
+            else:
+                log.warning(f"Order {order_id}: Maximum retries reached for Step {step}. Parking the order.")
+                parking_lot.park(order_id, step, error, state)  # Saved with the retry_count it failed at
+        else:
+            self.wait(order_id, step, self.retry_policies.retry_delay(step, counts[step]))
+        self.checkpoint.save(state, order_id)
+        return 0
+
+    def advance_cursor(self, order_id, state, counts, step):
+        """Forget a step's failures once it is done, and move "step" to the order's first step that isn't."""
+        counts.pop(step, None)
+        if not counts:
+            del self.retries[order_id]
+        state["retry_count"] = max(counts.values(), default=0)
+        state["step"] = self.logic.registry.first_pending(self.done_mask(state))
+
+    def advance_step(self, step, order_ids):
+        """Run one step for a group of orders, updating each order's state."""
+        if self.logic.registry.batchable(step):
+            return self.advance_batch(step, order_ids)
+        breaker = self.retry_policies.breaker_for(step)
+        timeout = self.logic.registry.timeout_for(step, self.step_timeout)
+        completed = 0
+        for position, order_id in enumerate(order_ids):
+            if not breaker.allow():
+                self.wait(order_id, step, breaker.remaining() or self.retry_wheel.tick)
+                continue
+            if not self.claim(step, order_id):
+                continue
+            delay = self.limiter.try_acquire(step)
+            if delay:
+                self.release(order_id)
+                held = [other for other in order_ids[position:] if (other, step) not in self.waiting]
+                self.throttle(step, held, delay)
+                self.limiter.queued(step, len(held))
+                return completed
+            try:
+                with metrics.registry.timer("step_latency_seconds", step=step):
+                    result = self.executor.run(self.logic_for(order_id).process_step, step, timeout)
+            except Exception as e:
+                result = e
+            self.limiter.release(step)
+            completed += self.record_result(step, order_id, result)
+            self.release(order_id)
+        self.limiter.queued(step, 0)
+        return completed
+
+    def advance_batch(self, step, order_ids):
+        """Run a batchable step with one process_step_batch() call per batch_size orders."""
+        now = time.monotonic()
+        if len(order_ids) < self.batch_size and self.batch_wait > 0:
+            deadline = self.batch_deadlines.setdefault(step, now + self.batch_wait)
+            if now < deadline:
+                for order_id in order_ids:
+                    self.wait(order_id, step, deadline - now)  # Hold the batch open for more orders
+                return 0
+        self.batch_deadlines.pop(step, None)
+
+        breaker = self.retry_policies.breaker_for(step)
+        timeout = self.logic.registry.timeout_for(step, self.step_timeout)
+        by_logic = {}  # Orders pinned to different logic versions run in separate batches
+        for order_id in order_ids:
+            if self.claim(step, order_id):
+                by_logic.setdefault(self.logic_for(order_id), []).append(order_id)
+
+        completed = held = 0
+        for logic, ids in by_logic.items():
+            for start in range(0, len(ids), self.batch_size):
+                batch = ids[start:start + self.batch_size]
+                if not breaker.allow():
+                    for order_id in batch:
+                        self.wait(order_id, step, breaker.remaining() or self.retry_wheel.tick)
+                        self.release(order_id)
+                    continue
+                delay = self.limiter.try_acquire(step)
+                if delay:
+                    for order_id in batch:
+                        self.wait(order_id, step, delay)  # The whole batch comes back together for the next token
+                        self.release(order_id)
+                    held += len(batch)
+                    continue
+                try:
+                    with metrics.registry.timer("step_batch_latency_seconds", step=step):
+                        results = self.executor.run(logic.process_step_batch, step, timeout, batch)
+                except Exception as e:
+                    results = [e] * len(batch)  # The whole batch failed
+                self.limiter.release(step)
+                metrics.registry.histogram("step_batch_size", step=step).observe(len(batch))
+                for order_id, result in zip(batch, results):
+                    completed += self.record_result(step, order_id, result)
+                    self.release(order_id)
+        self.limiter.queued(step, held)
+        return completed
+
+    def run_pass(self):
+        """Run every pending order's ready steps once. Returns the number of (order, step) pairs ready for the next pass."""
+        self.waiting.difference_update(self.retry_wheel.advance())  # Retries that fell due
+        groups = self.pending_by_step()
+        if not groups:
+            return 0
+
+        self.reload_task_logic()  # Reload once per pass instead of once per order
+        for step in sorted(groups):
+            order_ids = groups[step]
+            completed = self.advance_step(step, order_ids)
+            log.info(f"Step {step}: {completed} of {len(order_ids)} orders completed.")
+
+        self.checkpoint.boundary()
+        metrics.registry.maybe_export()
+
+        pending = self.pending_by_step()
+        for order_id in list(self.order_versions):
+            if self.orders[order_id]["step"] > self.max_steps:
+                del self.order_versions[order_id]  # Finished orders release their logic version
+        self.logic_reloader.release(set(self.order_versions.values()))
+        return sum(len(ids) for ids in pending.values())
+
+    def close(self):
+        """Stop the step workers and commit whatever the checkpoint policy has not."""
+        self.executor.close()
+        self.checkpoint.close()
+
+    def run(self):
+        try:
+            while self.run_pass() or self.waiting:
+                if not self.pending_by_step():
+                    time.sleep(self.retry_wheel.tick)  # Only retries are left; wait for the next one to fall due
+        finally:
+            self.close()
+        parked = len(parking_lot.parked())
+        log.info(f"Batch processing completed for {len(self.orders)} orders ({parked} parked)!")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process a stream of orders in one process.")
+    parser.add_argument("files", nargs="*", help="files of order IDs, one per line (default: stdin)")
+    parser.add_argument("--store", default="batch_state.pkl", help="state file; .db/.sqlite uses SQLite, .mmap a memory-mapped file")
+    parser.add_argument("--checkpoint", default="pass",
+                        help="when to commit state: pass (default), step, N transitions, Tms, exit, or e.g. 1000,250ms")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="per-step timeout in seconds, for steps that don't declare their own")
+    parser.add_argument("--isolation", choices=["thread", "process", "none"], default="thread",
+                        help="where steps run: a recyclable thread (default), a child process, or inline without a timeout")
+    parser.add_argument("--batch-size", type=int, default=1000, help="orders per call for steps that run in bulk")
+    parser.add_argument("--batch-wait", type=float, default=0.0,
+                        help="milliseconds to hold a short batch open for more orders (default: don't wait)")
+    parser.add_argument("--rerun", action="append", default=[], metavar="STEP",
+                        help="run a step (number or name) again for the given orders, with the steps downstream "
+                             "of it that revalidate; repeatable")
+    args, order_pipeline = pipeline.parse_args(parser)  # The spec's [engine] table supplies the defaults
+
+    # Order IDs come from the files given on the command line, or from stdin
+    if args.files:
+        order_ids = []
+        for path in args.files:
+            with open(path) as f:
+                order_ids.extend(read_order_ids(f))
+    else:
+        order_ids = read_order_ids(sys.stdin)
+
+    exit_on_signals()
+    order_processor = BatchOrderProcessing(order_ids, args.store, checkpoint=args.checkpoint,
+                                           step_timeout=args.timeout, isolation=args.isolation,
+                                           batch_size=args.batch_size, batch_wait=args.batch_wait / 1000,
+                                           pipeline=order_pipeline, rerun=args.rerun)
+    order_processor.run()
@@ -0,0 +1,121 @@
+import os
+import sys
+import queue
+import signal
+import socketserver
+import threading
+import time
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import metrics
+import pipeline
+import state_store
+from batch_processor import BatchOrderProcessing, parking_lot
+from ingest import Ingester
+
+SOCKET_PATH = os.environ.get("ORDER_RUNNER_SOCKET", "order_runner.sock")
+
+log = metrics.get_logger("daemon")
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """One client connection: a request per line, a reply line for each."""
+
+    def handle(self):
+        for line in self.rfile:
+            reply = self.server.runner.handle(line.decode().split())
+            self.wfile.write(reply.encode() + b"\n")
+            self.wfile.flush()
+
+class RunnerDaemon:
+    """Long-lived batch runner that takes orders over a Unix socket.
+
+    The logic module, the step registry and the state store are loaded once
+    and stay warm, so a submitted order starts on the next pass of a running
+    engine instead of paying for a Python start-up and a fresh import. The
+    protocol is one line per request, words separated by spaces:
+
+        submit ORDER_ID...   -> "ok N" once the orders are queued
+        status ORDER_ID      -> "step N", "parked at step N" or "not in flight"
+        stats                -> "in_flight=N queued=N ingested=N uptime=S"
+        stop                 -> "ok"; orders already in flight are finished first
+
+    Submissions go through a bounded queue into an Ingester, so a client
+    blocks in submit while the engine is max_in_flight orders behind. Use
+    submit.py, which imports nothing but the socket module, as the client.
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH, state_file="batch_state.db", queue_size=1024, max_in_flight=4096,
+                 pipeline=None):
+        self.socket_path = socket_path
+        self.submitted = queue.Queue(maxsize=queue_size)  # Order IDs from clients; None stops the daemon
+        self.engine = BatchOrderProcessing((), state_file, pipeline=pipeline)
+        source = ((order_id, None) for order_id in iter(self.submitted.get, None))
+        self.ingester = Ingester(self.engine, source, queue_size=queue_size, max_in_flight=max_in_flight)
+        self.started = time.monotonic()
+        self.stopping = False
+
+    def handle(self, words):
+        """Answer one request line, already split into words."""
+        if not words:
+            return "error empty request"
+        command, args = words[0], words[1:]
+        if command == "submit":
+            if self.stopping:
+                return "error daemon is stopping"
+            for order_id in args:
+                self.submitted.put(order_id)  # Blocks while the queue is full
+            return f"ok {len(args)}"
+        if command == "status" and len(args) == 1:
+            state = self.engine.orders.get(args[0])
+            if state is None:
+                return "not in flight"
+            parked = parking_lot.parked().get(args[0])
+            return f"parked at step {parked['step']}" if parked else f"step {state['step']}"
+        if command == "stats":
+            return (f"in_flight={len(self.engine.orders)} queued={self.submitted.qsize()} "
+                    f"ingested={self.ingester.ingested} uptime={time.monotonic() - self.started:.0f}")
+        if command == "stop":
+            self.stop()
+            return "ok"
+        return f"error unknown request {command!r}"
+
+    def stop(self, *_):
+        """Stop taking orders; the engine exits once the ones it has are finished or parked."""
+        if not self.stopping:
+            self.stopping = True
+            # From another thread: put() blocks while the queue is full, and this may be a signal handler
+            threading.Thread(target=self.submitted.put, args=(None,), daemon=True).start()
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)  # Left behind by a daemon that didn't shut down cleanly
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        server.daemon_threads = True
+        server.runner = self
+        threading.Thread(target=server.serve_forever, name="order-daemon-socket", daemon=True).start()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log.info(f"Order runner listening on {self.socket_path}.")
+        metrics.flush_logs(log)
+        try:
+            self.ingester.run()  # The engine runs on the main thread until stop()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(self.socket_path)
+            state_store.close_stores()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Keep a batch runner warm and take orders over a Unix socket.")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="socket path (default: $ORDER_RUNNER_SOCKET or order_runner.sock)")
+    parser.add_argument("--store", default="batch_state.db",
+                        help="state file: .db/.sqlite for SQLite (default) or .mmap for a memory-mapped file; "
+                             "the journal store would hold every order ever seen in memory")
+    parser.add_argument("--queue-size", type=int, default=1024, help="submitted orders queued ahead of the engine")
+    parser.add_argument("--max-in-flight", type=int, default=4096, help="unfinished orders held in memory")
+    args, order_pipeline = pipeline.parse_args(parser)
+    if state_store.backend_for(args.store) not in state_store.STREAMING_BACKENDS:
+        parser.error(f"--store {args.store}: use a .db, .sqlite or .mmap file, which keep finished orders on disk")
+
+    RunnerDaemon(args.socket, args.store, args.queue_size, args.max_in_flight, order_pipeline).serve()
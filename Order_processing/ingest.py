@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import queue
+import threading
+import time
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import metrics
+import pipeline
+import state_store
+from order_record import OrderRecord
+from batch_processor import BatchOrderProcessing
+
+END = object()  # Put on the queue once the source is exhausted
+
+log = metrics.get_logger("ingest")
+
+def parse_order_id(line):
+    """Order ID from one JSON line: an object with "order_id" (or "id"), or a bare string or number."""
+    try:
+        order = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(order, dict):
+        order = order.get("order_id", order.get("id"))
+    if isinstance(order, (str, int)) and not isinstance(order, bool):
+        return str(order)
+    return None
+
+def read_jsonl(path, offset=0):
+    """Yield (order_id, offset just past its line) from a JSON-lines file, from byte offset on."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            order_id = parse_order_id(line)
+            if order_id is None:
+                log.warning(f"{path}: skipping unreadable order line ending at byte {offset}.")
+                continue
+            yield order_id, offset
+
+def file_source(path, checkpoint=None):
+    """Orders from one JSON-lines file, resuming at the checkpointed offset."""
+    offset = checkpoint["offset"] if checkpoint else 0
+    for order_id, offset in read_jsonl(path, offset):
+        yield order_id, {"offset": offset}
+
+def spool_source(directory, checkpoint=None, follow=False, poll_interval=1.0):
+    """Orders from the *.jsonl files of a spool directory, in file name order.
+
+    The checkpoint names the file being read and the offset in it; files
+    that sort before it are finished. Producers should give files names
+    that sort in arrival order (e.g. a timestamp prefix) and move them into
+    the directory once complete. With follow=True the directory is polled
+    for new files instead of stopping when it runs dry.
+    """
+    current, offset = (checkpoint["file"], checkpoint["offset"]) if checkpoint else ("", 0)
+    while True:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".jsonl") and name >= current)
+        for name in names:
+            if name != current:
+                current, offset = name, 0
+            for order_id, offset in read_jsonl(os.path.join(directory, name), offset):
+                yield order_id, {"file": name, "offset": offset}
+        if not follow:
+            return
+        time.sleep(poll_interval)  # Only finished files are moved in, so the last one is fully read
+
+def stream_source(stream):
+    """Orders from a stream such as stdin. Streams can't be rewound, so there is nothing to checkpoint."""
+    for line in stream:
+        if line.strip():
+            order_id = parse_order_id(line)
+            if order_id is None:
+                log.warning("Skipping unreadable order line on the input stream.")
+                continue
+            yield order_id, None
+
+class Ingester:
+    """Feed orders from a source generator into a BatchOrderProcessing engine.
+
+    A reader thread pulls (order_id, position) pairs from the source and
+    puts them on a bounded queue; when the queue is full the reader blocks,
+    so a source never gets more than queue_size orders ahead of the engine.
+    The engine takes orders off the queue only while fewer than
+    max_in_flight are unfinished in memory, and retires finished and parked
+    orders after every pass. Memory therefore stays flat however large the
+    input is, with a .db store; the journal store keeps every order it has
+    seen in memory, and the .mmap store an index entry per order.
+
+    The position of the last order taken is saved under checkpoint_key in
+    checkpoints, a small state store of its own, once the engine's store has
+    committed the orders before it. A restart resumes after the last
+    checkpoint; orders read again after a crash between the two commits are
+    already in the engine's store, and add_order() keeps their progress.
+    """
+
+    def __init__(self, engine, source, checkpoints=None, checkpoint_key=None, queue_size=1024, max_in_flight=4096):
+        self.engine = engine
+        self.source = source
+        self.checkpoints = checkpoints
+        self.checkpoint_key = checkpoint_key
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_in_flight = max_in_flight
+        self.held = None  # Item taken off the queue while waiting for the source
+        self.exhausted = False
+        self.ingested = 0
+
+    @staticmethod
+    def checkpoint(checkpoints, checkpoint_key):
+        """Return the saved position for a source, or None to start from the beginning."""
+        record = checkpoints.load(checkpoint_key)
+        return record.get("position") if record else None
+
+    def read(self):
+        """Reader thread: copy the source onto the queue, blocking while it is full."""
+        try:
+            for item in self.source:
+                self.queue.put(item)
+        except Exception as e:
+            log.error(f"Ingestion source failed: {e}")
+        finally:
+            self.queue.put(END)
+
+    def take(self):
+        """Next item from the queue without blocking, or None."""
+        if self.held is not None:
+            item, self.held = self.held, None
+            return item
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def wait(self, timeout):
+        """Block until the source has something, for at most timeout seconds."""
+        try:
+            self.held = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            pass
+
+    def admit(self):
+        """Move orders from the queue into the engine while it has room. Returns how many."""
+        admitted = 0
+        position = None
+        while not self.exhausted and len(self.engine.orders) < self.max_in_flight:
+            item = self.take()
+            if item is None:
+                break
+            if item is END:
+                self.exhausted = True
+                break
+            order_id, position = item
+            self.engine.add_order(order_id)
+            admitted += 1
+        if admitted:
+            self.engine.checkpoint.flush()  # Orders first, so a checkpoint never skips an order that wasn't saved
+            if position is not None and self.checkpoints is not None:
+                self.checkpoints.save(OrderRecord(extra={"position": position}), self.checkpoint_key)
+                self.checkpoints.commit()
+            self.ingested += admitted
+            metrics.registry.counter("orders_ingested_total").inc(admitted)
+        return admitted
+
+    def run(self):
+        reader = threading.Thread(target=self.read, name="order-ingest", daemon=True)
+        reader.start()
+        while True:
+            admitted = self.admit()
+            if not self.engine.run_pass():
+                if self.engine.waiting:
+                    time.sleep(self.engine.retry_wheel.tick)  # Only retries are left; wait for the next one to fall due
+                elif self.exhausted:
+                    break
+                elif not admitted:
+                    self.wait(0.1)  # Idle: wake as soon as the next order arrives
+            self.engine.retire()
+        self.engine.close()
+        log.info(f"Ingested {self.ingested} orders.")
+        metrics.flush_logs(log)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Stream orders from JSON lines into the batch engine.")
+    parser.add_argument("source", nargs="?", default="-",
+                        help="JSON-lines file, spool directory of *.jsonl files, or - for stdin (default)")
+    parser.add_argument("--store", default="batch_state.db",
+                        help="state file: .db/.sqlite for SQLite (default) or .mmap for a memory-mapped file; "
+                             "the journal store would hold every order ever seen in memory")
+    parser.add_argument("--follow", action="store_true", help="keep polling a spool directory for new files")
+    parser.add_argument("--queue-size", type=int, default=1024, help="orders read ahead of the engine")
+    parser.add_argument("--max-in-flight", type=int, default=4096, help="unfinished orders held in memory")
+    args, order_pipeline = pipeline.parse_args(parser)
+    if state_store.backend_for(args.store) not in state_store.STREAMING_BACKENDS:
+        parser.error(f"--store {args.store}: use a .db, .sqlite or .mmap file, which keep finished orders on disk")
+
+    engine = BatchOrderProcessing((), args.store, pipeline=order_pipeline)
+    if args.source == "-":
+        checkpoints, key, source = None, None, stream_source(sys.stdin)
+    else:
+        checkpoints = state_store.open_store(f"{args.store}.ingest", backend="journal")
+        key = os.path.abspath(args.source)
+        checkpoint = Ingester.checkpoint(checkpoints, key)
+        if os.path.isdir(args.source):
+            source = spool_source(args.source, checkpoint, args.follow)
+        else:
+            source = file_source(args.source, checkpoint)
+
+    Ingester(engine, source, checkpoints, key, args.queue_size, args.max_in_flight).run()
+    state_store.close_stores()
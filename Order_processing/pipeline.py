@@ -0,0 +1,280 @@
+import os
+import sys
+import glob
+import hashlib
+import json
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import hot_reload
+from retry_policy import RateLimit, RetryPolicy, RetryPolicies, TokenBucket
+from state_store import write_atomic
+from step_registry import StepRegistry
+
+PLAN_FORMAT = 2  # Bump when the plan layout changes; older cached plans are then recompiled
+
+# The [engine] table gives defaults for the runner options of the same name
+ENGINE_OPTIONS = ("store", "checkpoint", "timeout", "isolation", "batch_size", "batch_wait")
+STEP_KEYS = ("name", "handler", "batch_handler", "depends_on", "timeout", "retry", "revalidate",
+             "concurrency", "rate", "burst")
+RETRY_KEYS = ("max_retries", "base_delay", "max_delay", "jitter", "on_exhausted")
+RETRY_DEFAULTS = {"max_retries": 3, "base_delay": 0.5, "max_delay": 30.0, "jitter": True, "on_exhausted": "park"}
+BUDGET_DEFAULTS = {"rate": 50.0, "capacity": 500, "breaker_threshold": 20, "breaker_reset": 5.0}
+
+def read_spec(path, data):
+    """Parse a pipeline spec by its extension: .toml, .json, or .yaml/.yml (needs PyYAML)."""
+    if path.endswith(".toml"):
+        import tomllib  # Python 3.11+; only needed for TOML specs
+        return tomllib.loads(data.decode())
+    if path.endswith(".json"):
+        return json.loads(data)
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml  # Only needed for YAML specs
+        except ImportError:
+            raise ValueError(f"{path}: YAML pipeline specs need PyYAML (pip install pyyaml); "
+                             f"or write the spec as .toml or .json") from None
+        return yaml.safe_load(data)
+    raise ValueError(f"{path}: pipeline specs are .toml, .json or .yaml files")
+
+def check_keys(where, table, allowed):
+    unknown = sorted(set(table) - set(allowed))
+    if unknown:
+        raise ValueError(f"{where}: unknown key(s) {', '.join(unknown)}; expected {', '.join(allowed)}")
+
+def compile_spec(spec):
+    """Validate a parsed spec and compile it into a plan of plain data, ready to cache as JSON.
+
+    Steps are numbered in the order the spec lists them, which must put
+    every step after the steps it depends on, so an order's step number
+    still reads as its progress. The dependency graph is compiled by a
+    StepRegistry, so a spec is held to the same rules as a logic module's
+    own registry, and the plan keeps its graph(); the batch engine runs a
+    step as soon as the steps in its depends_on are done.
+    """
+    check_keys("pipeline", spec, ("name", "module", "engine", "retry", "budget", "steps"))
+    for key in ("name", "module", "steps"):
+        if key not in spec:
+            raise ValueError(f"pipeline: missing {key!r}")
+    name = spec["name"]
+    engine = spec.get("engine", {})
+    check_keys(f"{name} [engine]", engine, ENGINE_OPTIONS)
+    retry = dict(RETRY_DEFAULTS, **spec.get("retry", {}))
+    check_keys(f"{name} [retry]", retry, RETRY_KEYS)
+    budget = dict(BUDGET_DEFAULTS, **spec.get("budget", {}))
+    check_keys(f"{name} [budget]", budget, tuple(BUDGET_DEFAULTS))
+
+    registry = StepRegistry()
+    steps = []
+    for number, step in enumerate(spec["steps"], 1):
+        check_keys(f"{name} step {number}", step, STEP_KEYS)
+        if "name" not in step:
+            raise ValueError(f"{name} step {number}: missing 'name'")
+        step_retry = step.get("retry", {})
+        check_keys(f"{name} step {step['name']} retry", step_retry, RETRY_KEYS)
+        compiled = {
+            "name": step["name"],
+            "handler": step.get("handler", step["name"]),
+            "batch_handler": step.get("batch_handler"),
+            "timeout": step.get("timeout"),
+            "retry": dict(retry, **step_retry) if step_retry else None,  # None: the pipeline's default policy
+            "on_exhausted": step_retry.get("on_exhausted", retry["on_exhausted"]),
+            "revalidate": step.get("revalidate", True),
+            "rate_limit": ({key: step.get(key) for key in ("concurrency", "rate", "burst")}
+                           if any(key in step for key in ("concurrency", "rate", "burst")) else None),
+        }
+        registry.register(number, step["name"], None, step.get("depends_on", ()), None, compiled["timeout"],
+                          compiled["on_exhausted"], compiled["revalidate"])
+        steps.append(compiled)
+    try:
+        registry.compile()
+    except ValueError as e:
+        raise ValueError(f"{name}: {e}") from None
+    for number in range(1, len(steps) + 1):
+        later = [dep for dep in registry.get_dependencies(number) if dep > number]
+        if later:
+            raise ValueError(f"{name}: step {steps[number - 1]['name']} is listed before "
+                             f"{registry.name_of(later[0])}, which it depends on")
+    return {"format": PLAN_FORMAT, "name": name, "module": spec["module"], "engine": engine,
+            "retry": retry, "budget": budget, "steps": steps, "graph": registry.graph()}
+
+def cache_path(path, digest):
+    """Where the plan compiled from a spec is cached: __pycache__ next to the spec, like a .pyc."""
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, "__pycache__", f"{filename}.{digest[:16]}.plan.json")
+
+def load(path):
+    """Return the Pipeline for the spec at path, compiling it only if no plan is cached for its contents."""
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    cached = cache_path(path, digest)
+    try:
+        with open(cached) as f:
+            plan = json.load(f)
+        if plan.get("format") == PLAN_FORMAT:
+            return Pipeline(plan, digest)
+    except (FileNotFoundError, ValueError):
+        pass  # Not compiled yet, or a cache file we can't use
+
+    plan = compile_spec(read_spec(path, data))
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    for stale in glob.glob(cached.replace(digest[:16], "*")):
+        os.remove(stale)  # Plans compiled from earlier versions of the spec
+    write_atomic(cached, json.dumps(plan).encode(), fsync=False)
+    return Pipeline(plan, digest)
+
+class PipelineLogic:
+    """A pipeline plan bound to one version of its logic module.
+
+    Quacks like a logic module to the runners: it has a step registry, and
+    process_step() and process_step_batch() dispatch to the handlers the
+    spec names.
+    """
+
+    def __init__(self, plan, module):
+        self.module = module
+        self.registry = StepRegistry()
+        for number, step in enumerate(plan["steps"], 1):
+            self.registry.register(number, step["name"], self.handler(plan, module, step["handler"]),
+                                   (), self.retry_policy(step["retry"]), step["timeout"],
+                                   step["on_exhausted"], step["revalidate"], self.rate_limit(step["rate_limit"]))
+            if step["batch_handler"]:
+                self.registry.batch_handlers[number] = self.handler(plan, module, step["batch_handler"])
+        self.registry.install(plan["graph"])  # Compiled when the plan was
+        self.process_step = self.registry.process_step
+        self.process_step_batch = self.registry.process_step_batch
+
+    @staticmethod
+    def handler(plan, module, name):
+        handler = getattr(module, name, None)
+        if not callable(handler):
+            raise ValueError(f"Pipeline {plan['name']}: {module.__name__} has no step handler {name!r}")
+        return handler
+
+    @staticmethod
+    def retry_policy(retry):
+        if retry is None:
+            return None
+        return RetryPolicy(retry["max_retries"], retry["base_delay"], retry["max_delay"], retry["jitter"])
+
+    @staticmethod
+    def rate_limit(limit):
+        return RateLimit(limit["concurrency"], limit["rate"], limit["burst"]) if limit else None
+
+class PipelineReloader(hot_reload.ModuleReloader):
+    """ModuleReloader for a pipeline's logic module that hands out PipelineLogic instead of the module.
+
+    The module is still reloaded when its source changes, and pinned
+    versions keep the plan bound to the module they started on.
+    """
+
+    def __init__(self, pipeline, check_interval=0.0):
+        self.pipeline = pipeline
+        super().__init__(pipeline.module_name, check_interval)
+        self.logic = PipelineLogic(pipeline.plan, self.module)
+
+    def check(self, module):
+        """Bind the plan to a reloaded module before it replaces the current one.
+
+        Raises ValueError if the new source lacks a handler the spec names,
+        which keeps the previous module, version and digest in place.
+        """
+        self.candidate = PipelineLogic(self.pipeline.plan, module)
+
+    def load(self):
+        module = super().load()
+        if self.logic.module is not module:
+            self.logic = self.candidate
+        return self.logic
+
+    def module_for(self, version):
+        return self.pinned.get(version, self.logic)
+
+class Pipeline:
+    """A compiled pipeline spec: its steps and dependency graph, retry strategy and engine options.
+
+    A spec (TOML shown; JSON and YAML take the same structure) names the
+    module the step handlers live in and lists the steps in order. A step
+    runs as soon as the steps in its depends_on have completed or been
+    skipped:
+
+        name = "orders"
+        module = "order_processing_logic"
+
+        [engine]                   # defaults for the runner's options, in their units
+        store = "orders_state.mmap"
+        batch_size = 500
+
+        [retry]                    # every step's policy unless it has its own
+        max_retries = 3
+        on_exhausted = "park"      # or "skip" the step and carry on
+
+        [[steps]]
+        name = "verify_payment"    # handler defaults to the name
+        timeout = 10
+        concurrency = 8            # calls in flight at once, and per second
+        rate = 50                  # (with bursts of up to burst calls)
+
+        [[steps]]
+        name = "generate_invoice"
+        depends_on = ["verify_payment"]
+        batch_handler = "generate_invoices"
+        retry = { max_retries = 5 }
+        revalidate = false         # keeps its result when a step upstream is rerun (--rerun)
+
+    [budget] sets the shared retry budget (rate, capacity) and the circuit
+    breakers (breaker_threshold, breaker_reset). load() caches the compiled
+    plan by the spec's hash, so only a changed spec is parsed and checked.
+    """
+
+    def __init__(self, plan, digest):
+        self.plan = plan
+        self.digest = digest
+        self.name = plan["name"]
+        self.module_name = plan["module"]
+        self.engine = plan["engine"]
+
+    def reloader(self, check_interval=0.0):
+        return PipelineReloader(self, check_interval)
+
+    def retry_policies(self):
+        """Build the RetryPolicies the spec asks for; steps with their own retry table get their own policy."""
+        per_step = {number: PipelineLogic.retry_policy(step["retry"])
+                    for number, step in enumerate(self.plan["steps"], 1) if step["retry"]}
+        budget = self.plan["budget"]
+        return RetryPolicies(PipelineLogic.retry_policy(self.plan["retry"]), per_step,
+                             TokenBucket(budget["rate"], budget["capacity"]),
+                             budget["breaker_threshold"], budget["breaker_reset"])
+
+def parse_args(parser, argv=None):
+    """Add --pipeline to a runner's parser and parse its arguments. Returns (args, pipeline or None).
+
+    The spec's [engine] table becomes the defaults of the runner's options,
+    so anything given on the command line still wins.
+    """
+    parser.add_argument("--pipeline", help="pipeline spec (.toml, .json or .yaml) declaring the steps to run")
+    known, _ = parser.parse_known_args(argv)
+    pipeline = load(known.pipeline) if known.pipeline else None
+    if pipeline:
+        parser.set_defaults(**pipeline.engine)
+    return parser.parse_args(argv), pipeline
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile a pipeline spec and show its execution plan.")
+    parser.add_argument("spec", help="pipeline spec (.toml, .json or .yaml)")
+    args = parser.parse_args()
+
+    pipeline = load(args.spec)
+    logic = pipeline.reloader().load()
+    registry = logic.registry
+    print(f"Pipeline {pipeline.name}: {registry.max_steps} steps from {pipeline.module_name} "
+          f"(plan {cache_path(args.spec, pipeline.digest)})")
+    for number in registry.order:
+        step = pipeline.plan["steps"][number - 1]
+        deps = ", ".join(registry.name_of(dep) for dep in registry.get_dependencies(number)) or "-"
+        retry = step["retry"] or pipeline.plan["retry"]
+        limit = step["rate_limit"] or {}
+        limits = "".join(f"  {key}: {limit[key]}" for key in ("concurrency", "rate", "burst") if limit.get(key))
+        print(f"  {number}. {step['name']:<20} after: {deps:<20} retries: {retry['max_retries']} then {step['on_exhausted']}"
+              f"{'  (batched)' if step['batch_handler'] else ''}{limits}")
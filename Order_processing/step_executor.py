@@ -0,0 +1,162 @@
+import multiprocessing
+import queue
+import threading
+import hot_reload
+import metrics
+
+class StepTimeout(Exception):
+    """A step ran past its deadline. Runners treat it as a retryable failure."""
+
+class ThreadWorker:
+    """Runs calls on a thread of its own.
+
+    A thread can't be killed: a hung worker is abandoned and exits when (if)
+    its call ever returns. Only the slot is recycled, not the thread.
+    """
+
+    def __init__(self, name):
+        self.inbox = queue.SimpleQueue()
+        self.outbox = queue.SimpleQueue()
+        threading.Thread(target=self.loop, name=name, daemon=True).start()
+
+    def loop(self):
+        while True:
+            call = self.inbox.get()
+            if call is None:
+                return
+            function, args = call
+            try:
+                result = (True, function(*args))
+            except Exception as e:
+                result = (False, e)
+            self.outbox.put(result)
+
+    def submit(self, function, *args):
+        self.inbox.put((function, args))
+
+    def result(self, timeout):
+        """Return (ok, value), or raise queue.Empty after timeout seconds."""
+        return self.outbox.get(timeout=timeout)
+
+    def stop(self, hung=False):
+        self.inbox.put(None)
+
+def process_worker_main(conn):
+    """Child side of a ProcessWorker: run the named functions, reloading their modules when they change."""
+    reloaders = {}
+    while True:
+        call = conn.recv()
+        if call is None:
+            return
+        module_name, qualname, args = call
+        try:
+            reloader = reloaders.get(module_name)
+            if reloader is None:
+                reloader = reloaders[module_name] = hot_reload.ModuleReloader(module_name)
+            function = reloader.load()
+            for name in qualname.split("."):
+                function = getattr(function, name)
+            result = (True, function(*args))
+        except Exception as e:
+            result = (False, Exception(f"{type(e).__name__}: {e}"))  # Not every exception pickles
+        conn.send(result)
+
+class ProcessWorker:
+    """Runs calls in a child process, which is killed if it hangs.
+
+    Functions are sent by module and qualified name and looked up in the
+    child's copy of the module, which it reloads when the source changes.
+    They must be module-level functions or attributes of module-level
+    classes, and see the current logic rather than an order's pinned version.
+    """
+
+    def __init__(self, name):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=process_worker_main, args=(child,), name=name, daemon=True)
+        self.process.start()
+        child.close()
+
+    def submit(self, function, *args):
+        self.conn.send((function.__module__, function.__qualname__, args))
+
+    def result(self, timeout):
+        if not self.conn.poll(timeout):
+            raise queue.Empty
+        return self.conn.recv()  # EOFError if the child died
+
+    def stop(self, hung=False):
+        if hung:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass  # Already gone
+        self.process.join(1.0)
+        self.conn.close()
+
+WORKERS = {
+    "thread": ThreadWorker,
+    "process": ProcessWorker,
+}
+
+class StepExecutor:
+    """Run step functions under a deadline on a pool of recyclable workers.
+
+    run() hands the call to an idle worker and waits at most timeout seconds
+    for it. On time, the worker goes back to the pool. Past the deadline the
+    worker is recycled: a process worker is killed, a thread worker is
+    abandoned, and a fresh worker takes its place. run() then raises
+    StepTimeout, so a hung step costs the caller one timeout, never the slot.
+    With isolation="none" steps run inline on the caller's thread and are
+    not timed out.
+    """
+
+    def __init__(self, workers=1, isolation="thread"):
+        if isolation not in WORKERS and isolation != "none":
+            raise ValueError(f"Unknown step isolation {isolation!r}; use thread, process or none")
+        self.isolation = isolation
+        self.idle = queue.SimpleQueue()
+        self.spawned = 0
+        self.recycled = 0
+        if isolation != "none":
+            for _ in range(workers):
+                self.idle.put(self.spawn())
+
+    def spawn(self):
+        self.spawned += 1
+        return WORKERS[self.isolation](f"step-worker-{self.spawned}")
+
+    def recycle(self, worker):
+        worker.stop(hung=True)
+        self.recycled += 1
+        metrics.registry.counter("step_workers_recycled_total", isolation=self.isolation).inc()
+        self.idle.put(self.spawn())
+
+    def run(self, process_step, step, timeout=None, *args):
+        """Return process_step(step, *args), raising StepTimeout if it takes longer than timeout seconds."""
+        if self.isolation == "none":
+            return process_step(step, *args)
+        worker = self.idle.get()
+        worker.submit(process_step, step, *args)
+        try:
+            ok, value = worker.result(timeout)
+        except queue.Empty:
+            self.recycle(worker)
+            metrics.registry.counter("step_timeouts_total", step=step).inc()
+            raise StepTimeout(f"Step {step} timed out after {timeout}s.")
+        except EOFError:
+            self.recycle(worker)
+            raise Exception(f"Step {step} worker exited while running the step.")
+        self.idle.put(worker)
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            worker.stop()
@@ -0,0 +1,66 @@
+"""Thin client for daemon.py.
+
+    python submit.py ORDER_ID...     submit orders (no IDs: read them from stdin, one per line)
+    python submit.py --status ID     where an order is
+    python submit.py --stats         what the daemon is doing
+    python submit.py --stop          finish the orders in flight and exit
+
+This runs once per submission, so it imports only os, sys and socket and
+parses its arguments by hand (argparse alone costs more than the rest of
+the start-up). Nothing from the runners is imported here; check with
+python -X importtime submit.py --stats.
+"""
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get("ORDER_RUNNER_SOCKET", "order_runner.sock")
+CHUNK = 1000  # Order IDs per submit line
+
+def connect(path=SOCKET_PATH):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+def request(sock, line):
+    """Send one request line and return the daemon's reply."""
+    sock.sendall(line.encode() + b"\n")
+    reply = b""
+    while not reply.endswith(b"\n"):
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("daemon closed the connection")
+        reply += data
+    return reply.decode().strip()
+
+def submit(sock, order_ids):
+    """Submit order IDs in chunks. Returns the number the daemon accepted."""
+    accepted = 0
+    for start in range(0, len(order_ids), CHUNK):
+        reply = request(sock, "submit " + " ".join(order_ids[start:start + CHUNK]))
+        if not reply.startswith("ok "):
+            raise RuntimeError(reply)
+        accepted += int(reply.split()[1])
+    return accepted
+
+def main(argv):
+    try:
+        sock = connect()
+    except OSError as e:
+        print(f"Cannot reach the order runner at {SOCKET_PATH}: {e}. Is daemon.py running?", file=sys.stderr)
+        return 1
+    with sock:
+        if argv[:1] == ["--status"] and len(argv) == 2:
+            print(request(sock, f"status {argv[1]}"))
+        elif argv in (["--stats"], ["--stop"]):
+            print(request(sock, argv[0][2:]))
+        elif argv and argv[0].startswith("-"):
+            print(__doc__, file=sys.stderr)
+            return 2
+        else:
+            order_ids = argv or [line.strip() for line in sys.stdin if line.strip()]
+            print(f"Submitted {submit(sock, order_ids)} orders.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+import os
+import sys
+import multiprocessing
+import queue
+import time
+import zlib
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import metrics
+import state_store
+import order_processing_logic
+from batch_processor import BatchOrderProcessing, read_order_ids, parking_lot
+
+log = metrics.get_logger("supervisor")
+
+def shard_for(order_id, shards):
+    """Shard an order lands on: stable across runs and processes, unlike hash()."""
+    return zlib.crc32(order_id.encode()) % shards
+
+def shard_file(state_file, shard):
+    """State file owned by one shard, e.g. batch_state.pkl -> batch_state.shard3.pkl."""
+    root, ext = os.path.splitext(state_file)
+    return f"{root}.shard{shard}{ext}"
+
+def take(source, limit, queued):
+    """Take up to limit order IDs from a queue without blocking."""
+    order_ids = []
+    while len(order_ids) < limit:
+        try:
+            order_ids.append(source.get_nowait())
+        except queue.Empty:
+            break
+    if order_ids:
+        with queued.get_lock():
+            queued.value -= len(order_ids)
+    return order_ids
+
+def steal(queues, shard, limit, queued):
+    """Take up to limit order IDs from the other shards' queues, fullest first."""
+    def backlog(other):
+        try:
+            return queues[other].qsize()
+        except NotImplementedError:  # macOS
+            return 0
+
+    victims = sorted((other for other in range(len(queues)) if other != shard), key=backlog, reverse=True)
+    for other in victims:
+        order_ids = take(queues[other], limit, queued)
+        if order_ids:
+            return other, order_ids
+    return None, []
+
+def worker_main(shard, queues, queued, state_file, batch_size, steal_batch):
+    """Process one shard: its own queue first, then orders stolen from the others.
+
+    The worker owns shard_file(state_file, shard) and resumes whatever it
+    holds when (re)started. An order belongs to the shard whose store it
+    was first saved in, so a stolen order is saved, and finished, here.
+    """
+    engine = BatchOrderProcessing((), shard_file(state_file, shard))
+    while True:
+        order_ids = take(queues[shard], batch_size, queued)
+        if not order_ids and not engine.pending_by_step():
+            victim, order_ids = steal(queues, shard, steal_batch, queued)
+            if order_ids:
+                metrics.registry.counter("orders_stolen_total", shard=shard).inc(len(order_ids))
+                log.info(f"Shard {shard}: stole {len(order_ids)} orders from shard {victim}.")
+        for order_id in order_ids:
+            engine.add_order(order_id)
+        if order_ids:
+            engine.checkpoint.flush()  # Taken orders survive a crash of this worker
+
+        if engine.run_pass():
+            continue
+        if engine.waiting:
+            time.sleep(engine.retry_wheel.tick)  # Only retries are left; wait for the next one to fall due
+        elif not order_ids and queued.value == 0:
+            break  # Nothing queued anywhere, nothing pending here
+    engine.close()
+    metrics.flush_logs(log)
+
+class Supervisor:
+    """Run orders on N worker processes, one shard of the order IDs each.
+
+    Orders are routed to a shard by crc32(order_id) and queued on that
+    shard's multiprocessing queue; each worker owns its own state store, so
+    workers never write the same file. A worker whose queue and passes run
+    dry steals from the fullest queue. Workers that crash are restarted (up
+    to max_restarts times per shard) and resume from their persisted state.
+    """
+
+    def __init__(self, workers=None, state_file="batch_state.pkl", batch_size=64, steal_batch=16, max_restarts=5):
+        self.workers = workers or os.cpu_count()
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.steal_batch = steal_batch
+        self.max_restarts = max_restarts
+        self.restarts = [0] * self.workers
+
+    def start_worker(self, shard):
+        process = multiprocessing.Process(
+            target=worker_main, name=f"order-worker-{shard}",
+            args=(shard, self.queues, self.queued, self.state_file, self.batch_size, self.steal_batch))
+        process.start()
+        return process
+
+    def saved_orders(self):
+        """Return {order_id: state} across every shard's store."""
+        orders = {}
+        for shard in range(self.workers):
+            orders.update(state_store.open_store(shard_file(self.state_file, shard)).load_all())
+        state_store.close_stores()  # Workers own the files from here on
+        return orders
+
+    def run_round(self, order_ids):
+        self.queues = [multiprocessing.Queue() for _ in range(self.workers)]
+        self.queued = multiprocessing.Value("q", len(order_ids))  # Orders put but not yet taken by a worker
+        processes = [self.start_worker(shard) for shard in range(self.workers)]
+
+        for order_id in order_ids:
+            self.queues[shard_for(order_id, self.workers)].put(order_id)
+
+        while any(process is not None for process in processes):
+            for shard, process in enumerate(processes):
+                if process is None or process.is_alive():
+                    continue
+                process.join()
+                if process.exitcode == 0:
+                    processes[shard] = None
+                elif self.restarts[shard] < self.max_restarts:
+                    self.restarts[shard] += 1
+                    log.warning(f"Worker for shard {shard} exited with code {process.exitcode}; "
+                                f"restarting it ({self.restarts[shard]} of {self.max_restarts}).")
+                    processes[shard] = self.start_worker(shard)
+                else:
+                    log.error(f"Worker for shard {shard} keeps crashing; giving up on it.")
+                    processes[shard] = None
+            time.sleep(0.1)
+
+    def run(self, order_ids):
+        saved = self.saved_orders()
+        pending = [order_id for order_id in dict.fromkeys(order_ids) if order_id not in saved]
+        while True:
+            self.run_round(pending)  # Workers also resume the unfinished orders already in their stores
+            saved = self.saved_orders()
+            # Orders a crashed worker took off its queue before saving them go round again
+            missing = [order_id for order_id in pending if order_id not in saved]
+            if not missing:
+                break
+            if len(missing) == len(pending):
+                log.error(f"{len(missing)} orders could not be handed to any worker.")
+                break
+            pending = missing
+
+        max_steps = order_processing_logic.registry.max_steps
+        done = sum(1 for state in saved.values() if state["step"] > max_steps)
+        log.info(f"Supervisor completed {done} of {len(saved)} orders on {self.workers} workers "
+                 f"({len(parking_lot.parked())} parked)!")
+        metrics.flush_logs(log)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process orders on a pool of worker processes, one shard each.")
+    parser.add_argument("files", nargs="*", help="files of order IDs, one per line (default: stdin)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: one per core)")
+    parser.add_argument("--store", default="batch_state.pkl",
+                        help="state file name; each shard gets its own, e.g. batch_state.shard0.pkl")
+    parser.add_argument("--batch-size", type=int, default=64, help="orders a worker takes from its queue at a time")
+    parser.add_argument("--steal-batch", type=int, default=16, help="orders an idle worker steals at a time")
+    parser.add_argument("--max-restarts", type=int, default=5, help="restarts per crashed worker before giving up")
+    args = parser.parse_args()
+
+    if args.files:
+        order_ids = []
+        for path in args.files:
+            with open(path) as f:
+                order_ids.extend(read_order_ids(f))
+    else:
+        order_ids = list(read_order_ids(sys.stdin))
+
+    supervisor = Supervisor(args.workers, args.store, args.batch_size, args.steal_batch, args.max_restarts)
+    supervisor.run(order_ids)
@@ -1,8 +1,11 @@
 # task_logic.py
 
+import asyncio
 import time
 
 class TaskLogic:
+    MAX_STEPS = 5  # Steps 1-5; there is no step registry to count them
+
     @staticmethod
     def run_step(step_number):
         """Simulate a task that can fail."""
@@ -14,3 +17,11 @@ class TaskLogic:
         #     raise Exception("Error encountered during step 3!")
 
         return True  # Indicate successful execution
+
+    @staticmethod
+    async def run_step_async(step_number):
+        """Awaitable version of run_step that yields the event loop while working."""
+        print(f"Running step {step_number}...")
+        await asyncio.sleep(1)  # Simulate a network call
+
+        return True  # Indicate successful execution
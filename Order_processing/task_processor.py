@@ -1,64 +1,143 @@
-import pickle
-import time
+import os
 import sys
-import importlib
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import metrics
+import parking
+import time
+import hot_reload
 import order_processing_logic  # Import the order processing logic module
+from checkpoint import CheckpointPolicy, exit_on_signals
+from step_executor import StepExecutor, StepTimeout
+from retry_policy import RetryPolicies
 
-def save_state(data, filename="order_state.pkl"):
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+def open_state_store(filename="order_state.pkl"):
+    return state_store.open_store(filename, group_size=1024,  # Written when the checkpoint policy commits
+                                  max_steps=order_processing_logic.registry.max_steps)
 
 def load_state(filename="order_state.pkl"):
-    try:
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return None
+    return open_state_store(filename).load()
+
+logic_reloader = hot_reload.ModuleReloader("order_processing_logic")
+parking_lot = parking.ParkingLot()
+log = metrics.get_logger("task_processor")
 
 class OrderProcessingWithRetry:
-    def __init__(self):
+    def __init__(self, unattended=False, checkpoint="step", step_timeout=30.0, isolation="thread", retry_policies=None):
         self.state = load_state() or {"step": 1, "retry_count": 0}
-        self.max_steps = 5
-        self.max_retries = 3
+        self.max_steps = order_processing_logic.registry.max_steps
+        self.retry_policies = retry_policies or RetryPolicies(per_step=order_processing_logic.registry.retry_policies())
+        self.unattended = unattended  # Park failed orders instead of prompting
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, open_state_store())
+        self.step_timeout = step_timeout  # For steps that don't declare their own
+        self.executor = StepExecutor(isolation=isolation)
+
+    def save_state(self):
+        self.checkpoint.save(self.state)
+
+    def max_retries(self, step):
+        return self.retry_policies.policy_for(step).max_retries
 
     def reload_task_logic(self):
-        """Dynamically reload the order_processing_logic module."""
-        if "order_processing_logic" in sys.modules:
-            del sys.modules["order_processing_logic"]  # Remove from cache
+        """Reload the order_processing_logic module if its source changed."""
         global order_processing_logic
-        importlib.import_module("order_processing_logic")  # Reimport fresh module
-        order_processing_logic = sys.modules["order_processing_logic"]  # Update the reference
+        with metrics.registry.timer("logic_reload_seconds"):
+            order_processing_logic = logic_reloader.load()
+        self.max_steps = order_processing_logic.registry.max_steps
+
+    def park(self, error):
+        """Park the order for an operator instead of blocking on input()."""
+        parking_lot.park(state_store.DEFAULT_ORDER, self.state["step"], error, self.state)
+        self.save_state()
+        self.checkpoint.flush()
+        log.error(f"Error: {error}. Order parked at Step {self.state['step']}; "
+                  f"release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' and run again.")
+
+    def is_parked(self):
+        if self.unattended and parking_lot.is_parked(state_store.DEFAULT_ORDER):
+            log.warning(f"Order is parked; release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' first.")
+            return True
+        if parking_lot.resume(self.state):
+            self.save_state()  # Released by an operator; retries start afresh
+        return False
 
     def run(self):
+        if self.is_parked():
+            return
+        try:
+            self.process()
+        finally:
+            self.executor.close()
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+
+    def process(self):
         while self.state["step"] <= self.max_steps:
+            step = self.state["step"]
+            breaker = self.retry_policies.breaker_for(step)
+            if not breaker.allow():
+                time.sleep(breaker.remaining() or 0.05)  # Let the service behind the step recover first
+                continue
             try:
-                print(f"Processing Step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries})...")
+                log.info(f"Processing Step {step} (Retry {self.state['retry_count']} of {self.max_retries(step)})...")
                 self.reload_task_logic()  # Reload the task logic dynamically
 
-                # Run the task logic for the current step
-                success = order_processing_logic.process_step(self.state["step"])
+                # Run the task logic for the current step, on a worker that is recycled if it hangs
+                timeout = order_processing_logic.registry.timeout_for(step, self.step_timeout)
+                with metrics.registry.timer("step_latency_seconds", step=step):
+                    success = self.executor.run(order_processing_logic.process_step, step, timeout)
 
                 if success:
+                    breaker.record_success()
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
-                    save_state(self.state)
-                    print(f"Step {self.state['step'] - 1} completed successfully!")
+                    self.save_state()
+                    log.info(f"Step {self.state['step'] - 1} completed successfully!")
 
             except Exception as e:
-                print(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                breaker.record_failure()
+                if isinstance(e, StepTimeout) and self.state["retry_count"] < self.max_retries(step):
+                    self.state["retry_count"] += 1  # A timeout is retried without bothering the operator
+                    metrics.registry.counter("step_retries_total", step=step).inc()
+                    delay = self.retry_policies.retry_delay(step, self.state["retry_count"])
+                    log.warning(f"{e} Retrying in {delay:.2f}s ({self.state['retry_count']} of {self.max_retries(step)}).")
+                    self.save_state()
+                    self.checkpoint.flush()  # Don't sit on uncommitted progress through the backoff
+                    time.sleep(delay)  # One order and nothing else to run meanwhile, as in Stepdependencies
+                    continue
+                if self.unattended:
+                    self.park(e)
+                    return
+                log.error(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.checkpoint.flush()  # Don't leave progress uncommitted while waiting on the operator
                 input("Press Enter to resume...")  # Wait for user to resolve the issue
                 self.state["retry_count"] += 1
+                metrics.registry.counter("step_retries_total", step=self.state["step"]).inc()
 
-                if self.state["retry_count"] > self.max_retries:
-                    print(f"Maximum retries reached for Step {self.state['step']}. Skipping to the next step.")
+                if self.state["retry_count"] > self.max_retries(self.state["step"]):
+                    log.warning(f"Maximum retries reached for Step {self.state['step']}. Skipping to the next step.")
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
 
-                save_state(self.state)
+                self.save_state()
                 continue
 
-        print("Order processing completed successfully!")
+        metrics.registry.counter("orders_completed_total").inc()
+        log.info("Order processing completed successfully!")
 
 if __name__ == "__main__":
-    order_processor = OrderProcessingWithRetry()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unattended", action="store_true", help="park the order on failure instead of prompting")
+    parser.add_argument("--checkpoint", default="step",
+                        help="when to commit state: step (default), N transitions, Tms, exit, or e.g. 10,250ms")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="per-step timeout in seconds, for steps that don't declare their own")
+    parser.add_argument("--isolation", choices=["thread", "process", "none"], default="thread",
+                        help="where steps run: a recyclable thread (default), a child process that is killed "
+                             "when it hangs, or inline without a timeout")
+    args = parser.parse_args()
+
+    exit_on_signals()
+    order_processor = OrderProcessingWithRetry(args.unattended, args.checkpoint, args.timeout, args.isolation)
     order_processor.run()
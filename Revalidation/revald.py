@@ -1,66 +1,141 @@
-import pickle
+import os
 import sys
-import importlib
+import hashlib
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import metrics
+import parking
+import hot_reload
+import step_cache
 import task_logic
+from checkpoint import CheckpointPolicy, exit_on_signals
+from retry_policy import RetryPolicies
 
-def save_state(data, filename="state.pkl"):
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+MAX_STEPS = 5
+
+def open_state_store(filename="state.pkl"):
+    return state_store.open_store(filename, max_steps=MAX_STEPS)
 
 def load_state(filename="state.pkl"):
-    try:
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return None
+    return open_state_store(filename).load()
+
+def fingerprint(*parts):
+    """Short stable hash of the repr of the given values."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+logic_reloader = hot_reload.ModuleReloader("task_logic")
+parking_lot = parking.ParkingLot()
+log = metrics.get_logger("revalidation")
+result_cache = step_cache.StepCache(filename="step_results")
 
 class TaskWithDependencyHandling:
-    def __init__(self):
+    def __init__(self, unattended=False, force=False, checkpoint="step", retry_policies=None):
         self.state = load_state() or {"step": 1, "retry_count": 0, "needs_revalidation": False}
-        self.max_steps = 5
-        self.max_retries = 3
+        self.state.setdefault("fingerprints", {})  # step -> {"input": ..., "output": ...} of its last pass
+        self.max_steps = MAX_STEPS
+        self.retry_policies = retry_policies or RetryPolicies()  # task_logic has no step registry to declare per-step policies
+        self.unattended = unattended  # Park failed orders instead of prompting
+        self.force = force  # Re-run every step on revalidation, ignoring fingerprints and cached results
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, open_state_store())
+
+    def save_state(self):
+        self.checkpoint.save(self.state)
+
+    def max_retries(self, step):
+        return self.retry_policies.policy_for(step).max_retries
 
     def reload_task_logic(self):
-        """Reload the task_logic module dynamically."""
-        if "task_logic" in sys.modules:
-            del sys.modules["task_logic"]
+        """Reload the task_logic module if its source changed."""
         global task_logic
-        importlib.import_module("task_logic")
-        task_logic = sys.modules["task_logic"]
-        print("Reloaded task_logic module.")
+        with metrics.registry.timer("logic_reload_seconds"):
+            task_logic = logic_reloader.load()
+
+    def input_fingerprint(self, step, upstream_output):
+        """Fingerprint of what a step's result depends on: the logic code and the step before it."""
+        return fingerprint(step, logic_reloader.digest, upstream_output)
+
+    def cache_key(self, step, inputs):
+        return result_cache.key(state_store.DEFAULT_ORDER, step, inputs, logic_reloader.digest)
+
+    def record_pass(self, step, result):
+        """Remember the inputs and output of a step that just passed, and cache its result."""
+        previous = self.state["fingerprints"].get(step - 1)
+        upstream_output = previous["output"] if previous else None
+        inputs = self.input_fingerprint(step, upstream_output)
+        self.state["fingerprints"][step] = {"input": inputs, "output": fingerprint(result)}
+        result_cache.put(self.cache_key(step, inputs), result)
 
     def revalidate_steps(self):
-        """Revalidate all steps up to the current step if necessary."""
-        print("Revalidation triggered...")
+        """Re-run the completed steps whose logic or upstream inputs changed since they last passed."""
+        log.info("Revalidation triggered...")
+        upstream_output = None
         for step in range(1, self.state["step"]):
+            recorded = self.state["fingerprints"].get(step)
+            inputs = self.input_fingerprint(step, upstream_output)
+            if not self.force and recorded and recorded["input"] == inputs:
+                log.info(f"Step {step} unchanged since it last passed. Skipping revalidation.")
+                upstream_output = recorded["output"]
+                continue
             try:
-                print(f"Revalidating step {step}...")
-                success = task_logic.TaskLogic.run_step(step)
-                if not success:
-                    print(f"Step {step} failed during revalidation. Restarting from step {step}.")
-                    self.state["step"] = step
-                    self.state["retry_count"] = 0
-                    save_state(self.state)
-                    return False
+                cached = step_cache.MISS if self.force else result_cache.get(self.cache_key(step, inputs))
+                if cached is not step_cache.MISS:
+                    log.info(f"Step {step} passed before with these inputs; using the cached result.")
+                    success = cached
+                else:
+                    log.info(f"Revalidating step {step}...")
+                    with metrics.registry.timer("step_latency_seconds", step=step):
+                        success = task_logic.TaskLogic.run_step(step)
             except Exception as e:
-                print(f"Error during revalidation of step {step}: {e}")
+                log.error(f"Error during revalidation of step {step}: {e}")
+                self.state["step"] = step
+                self.state["retry_count"] = 0
+                self.save_state()
+                return False
+            if not success:
+                log.warning(f"Step {step} failed during revalidation. Restarting from step {step}.")
                 self.state["step"] = step
                 self.state["retry_count"] = 0
-                save_state(self.state)
+                self.save_state()
                 return False
-        print("Revalidation completed successfully.")
+            self.record_pass(step, success)
+            upstream_output = self.state["fingerprints"][step]["output"]
+        log.info("Revalidation completed successfully.")
         return True
 
+    def park(self, error):
+        """Park the order for an operator instead of blocking on input()."""
+        parking_lot.park(state_store.DEFAULT_ORDER, self.state["step"], error, self.state)
+        self.save_state()
+        self.checkpoint.flush()
+        log.error(f"Error: {error}. Order parked at Step {self.state['step']}; "
+                  f"release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' and run again.")
+
+    def is_parked(self):
+        if self.unattended and parking_lot.is_parked(state_store.DEFAULT_ORDER):
+            log.warning(f"Order is parked; release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' first.")
+            return True
+        if parking_lot.resume(self.state):
+            self.save_state()  # Released by an operator; retries start afresh
+        return False
+
     def run(self):
+        if self.is_parked():
+            return
+        try:
+            self.process()
+        finally:
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+
+    def process(self):
         while self.state["step"] <= self.max_steps:
             if self.state["retry_count"] == 0:
-                print(f"Starting step {self.state['step']}...")
+                log.info(f"Starting step {self.state['step']}...")
             try:
                 # Reload task logic only when revalidation is needed
                 if self.state["needs_revalidation"]:
                     self.reload_task_logic()
 
-                    # Revalidate all steps up to the current step
+                    # Revalidate the completed steps whose fingerprints changed
                     if not self.revalidate_steps():
                         continue
 
@@ -68,27 +143,48 @@ class TaskWithDependencyHandling:
                     self.state["needs_revalidation"] = False
 
                 # Execute the current step
-                success = task_logic.TaskLogic.run_step(self.state["step"])
-                if success:
-                    self.state["step"] += 1
-                    self.state["retry_count"] = 0
-                    save_state(self.state)
+                with metrics.registry.timer("step_latency_seconds", step=self.state["step"]):
+                    success = task_logic.TaskLogic.run_step(self.state["step"])
             except Exception as e:
-                print(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                if self.unattended:
+                    self.state["needs_revalidation"] = True  # Revalidate once the order is released
+                    self.park(e)
+                    return
+                log.error(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.checkpoint.flush()  # Don't leave progress uncommitted while waiting on the operator
                 input("Press Enter to resume...")
                 self.state["needs_revalidation"] = True
                 self.state["retry_count"] += 1
+                metrics.registry.counter("step_retries_total", step=self.state["step"]).inc()
 
-                if self.state["retry_count"] > self.max_retries:
-                    print(f"Maximum retries reached for step {self.state['step']}. Skipping to the next step.")
+                if self.state["retry_count"] > self.max_retries(self.state["step"]):
+                    log.warning(f"Maximum retries reached for step {self.state['step']}. Skipping to the next step.")
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
 
-                save_state(self.state)
+                self.save_state()
                 continue
 
-        print("Task completed successfully!")
+            # Only a failing step counts as a failure, not recording its result
+            if success:
+                self.record_pass(self.state["step"], success)
+                self.state["step"] += 1
+                self.state["retry_count"] = 0
+                self.save_state()
+
+        metrics.registry.counter("orders_completed_total").inc()
+        log.info("Task completed successfully!")
 
 if __name__ == "__main__":
-    task = TaskWithDependencyHandling()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unattended", action="store_true", help="park the order on failure instead of prompting")
+    parser.add_argument("--force", action="store_true", help="revalidate every step, bypassing the result cache")
+    parser.add_argument("--checkpoint", default="step",
+                        help="when to commit state: step (default), N transitions, Tms, exit, or e.g. 10,250ms")
+    args = parser.parse_args()
+
+    exit_on_signals()
+    task = TaskWithDependencyHandling(args.unattended, args.force, args.checkpoint)
     task.run()
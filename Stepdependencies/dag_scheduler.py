@@ -0,0 +1,92 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+def topological_order(steps, get_dependencies):
+    """Return the steps ordered so that every step follows its dependencies."""
+    steps = list(steps)
+    remaining = {step: set(get_dependencies(step)) & set(steps) for step in steps}
+    order = []
+    while remaining:
+        ready = sorted(step for step, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError(f"Dependency cycle between steps {sorted(remaining)}")
+        for step in ready:
+            order.append(step)
+            del remaining[step]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+class DagScheduler:
+    """Run steps on a thread or process pool as soon as their dependencies finish.
+
+    With a limiter (a StepLimiter), a ready step also waits for its rate
+    limit to admit it; meanwhile the other ready steps still start.
+    """
+
+    def __init__(self, get_dependencies, max_workers=4, executor="thread", limiter=None):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown executor type: {executor}")
+        self.get_dependencies = get_dependencies
+        self.max_workers = max_workers
+        self.executor = executor
+        self.limiter = limiter
+
+    def make_executor(self):
+        if self.executor == "process":
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def run(self, steps, process_step, completed=(), on_success=None):
+        """Run the given steps, skipping those already completed.
+
+        process_step(step) runs in the pool; on_success(step) is called in the
+        calling thread after each step succeeds. Returns a dict of failed steps
+        mapped to their exception. Steps downstream of a failure are not started.
+        """
+        order = topological_order(steps, self.get_dependencies)
+        done = set(completed)
+        pending = [step for step in order if step not in done]
+        failed = {}
+        running = {}
+
+        with self.make_executor() as pool:
+            while pending or running:
+                throttled = {}  # step -> seconds until its rate limit may admit it
+                for step in list(pending):
+                    deps = set(self.get_dependencies(step))
+                    if deps & set(failed):
+                        pending.remove(step)  # Blocked by a failed dependency
+                    elif deps <= done:
+                        delay = self.limiter.try_acquire(step) if self.limiter else 0
+                        if self.limiter:
+                            self.limiter.queued(step, 1 if delay else 0)
+                        if delay:
+                            throttled[step] = delay
+                            continue
+                        pending.remove(step)
+                        running[pool.submit(process_step, step)] = step
+
+                retry_in = min(throttled.values(), default=None)
+                if not running:
+                    if retry_in is None:
+                        break
+                    time.sleep(retry_in)
+                    continue
+
+                finished, _ = wait(running, timeout=retry_in, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    if self.limiter:
+                        self.limiter.release(step)
+                    try:
+                        if not future.result():
+                            raise Exception(f"Step {step} failed.")
+                    except Exception as e:
+                        failed[step] = e
+                        continue
+                    done.add(step)
+                    if on_success:
+                        on_success(step)
+
+        return failed
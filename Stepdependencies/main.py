@@ -1,138 +1,268 @@
-import pickle
-import time
+import os
 import sys
-import importlib
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import metrics
+import parking
+import time
+import hot_reload
+import argparse
 import order_processing_logic  # Import the order processing logic module
+from dag_scheduler import DagScheduler
+from retry_policy import RetryPolicies, StepLimiter
+from order_record import OrderRecord
+from checkpoint import CheckpointPolicy, exit_on_signals
 
-def save_state(data, filename="order_state.pkl"):
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+def open_state_store(filename="order_state.pkl"):
+    return state_store.open_store(filename, max_steps=order_processing_logic.registry.max_steps)
 
 def load_state(filename="order_state.pkl"):
-    try:
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return None
+    return open_state_store(filename).load()
+
+logic_reloader = hot_reload.ModuleReloader("order_processing_logic")
+parking_lot = parking.ParkingLot()
+log = metrics.get_logger("stepdependencies")
 
 class OrderProcessingWithDependencies:
-    def __init__(self):
-        self.state = load_state() or {"step": 1, "retry_count": 0}
-        self.max_steps = 5
-        self.max_retries = 3
+    def __init__(self, unattended=False, retry_policies=None, checkpoint="step"):
+        self.state = load_state() or OrderRecord()  # Old step_N_completed flags load as completed_mask bits
+        self.max_steps = order_processing_logic.registry.max_steps
+        self.retry_policies = retry_policies or RetryPolicies(per_step=order_processing_logic.registry.retry_policies())
+        self.max_retries = self.retry_policies.default.max_retries
+        self.unattended = unattended  # Park failed orders instead of prompting
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, open_state_store())
+
+    def save_state(self):
+        self.checkpoint.save(self.state)
 
     def reload_task_logic(self):
-        """Dynamically reload the order_processing_logic module."""
-        if "order_processing_logic" in sys.modules:
-            del sys.modules["order_processing_logic"]  # Remove from cache
+        """Reload the order_processing_logic module if its source changed."""
         global order_processing_logic
-        importlib.import_module("order_processing_logic")  # Reimport fresh module
-        order_processing_logic = sys.modules["order_processing_logic"]  # Update the reference
+        with metrics.registry.timer("logic_reload_seconds"):
+            order_processing_logic = logic_reloader.load()
+        self.max_steps = order_processing_logic.registry.max_steps
 
     def get_dependencies(self, step):
-        """Return a list of steps that are dependent on the current step."""
-        dependencies = {
-            2: [1],  # Step 2 depends on Step 1
-            3: [1, 2],  # Step 3 depends on Steps 1 and 2
-            4: [1,3],  # Step 4 depends on Steps 1, 2, and 3
-            5: [1, 2, 3, 4],  # Step 5 depends on Steps 1, 2, 3, and 4
-        }
-        return dependencies.get(step, [])
+        """Return the steps that the given step depends on, as declared in the step registry."""
+        return order_processing_logic.registry.get_dependencies(step)
+
+    def mark_completed(self, step):
+        self.state["completed_mask"] |= order_processing_logic.registry.bit(step)
+        self.save_state()
 
-    import time
+    def invalidate(self, step):
+        """Forget that step and everything downstream of it completed, so they run again."""
+        registry = order_processing_logic.registry
+        before = self.state["completed_mask"]
+        self.state["completed_mask"] = registry.invalidate(step, before)
+        dropped = registry.steps_in(before & ~self.state["completed_mask"])
+        if dropped:
+            log.info(f"Invalidated Steps {dropped}, which depend on Step {step}.")
 
     def retry_step_with_dependencies(self, step):
         """Retry a specific step and its dependencies, ensuring no redundant retries."""
-        print(f"Retrying Step {step} and its dependencies automatically (Retry {self.state['retry_count']} of {self.max_retries})...")
-
-        # Get all dependencies for the current step
-        dependencies = self.get_dependencies(step)
-        self.reload_task_logic() 
+        log.info(f"Retrying Step {step} and its dependencies automatically (Retry {self.state['retry_count']} of {self.max_retries})...")
 
-        # Ensure that we don't re-run already completed steps
-        completed_steps = {step for step in range(1, self.state['step']) if self.state.get(f"step_{step}_completed", False)}
+        self.reload_task_logic()
+        registry = order_processing_logic.registry
 
-        # Include the current step itself for retries
-        steps_to_retry = dependencies + [step]
-        steps_to_retry = [s for s in steps_to_retry if s not in completed_steps]
+        # The step plus every dependency, direct or transitive, that hasn't completed, in dependency order
+        steps_to_retry = registry.steps_in(registry.retry_set(step, self.state["completed_mask"]))
 
         if steps_to_retry:
             for dep_step in steps_to_retry:
-                print(f"Retrying Step {dep_step}...")
+                log.info(f"Retrying Step {dep_step}...")
+                policy = self.retry_policies.policy_for(dep_step)
+                breaker = self.retry_policies.breaker_for(dep_step)
                 retry_attempts = 0
-                while retry_attempts < self.max_retries:
+                while retry_attempts < policy.max_retries:
+                    if not breaker.allow():
+                        raise Exception(f"Circuit open for Step {dep_step}; retry in {breaker.remaining():.1f}s.")
                     try:
                         # Retry the step
-                        success = order_processing_logic.process_step(dep_step)
+                        with metrics.registry.timer("step_latency_seconds", step=dep_step):
+                            success = order_processing_logic.process_step(dep_step)
                         if success:
-                            print(f"Step {dep_step} completed successfully!")
-                            self.state[f"step_{dep_step}_completed"] = True  # Mark as completed
-                            save_state(self.state)
+                            breaker.record_success()
+                            log.info(f"Step {dep_step} completed successfully!")
+                            self.mark_completed(dep_step)
                             break  # Exit retry loop if successful
                         else:
                             raise Exception(f"Step {dep_step} failed again.")
                     except Exception as e:
+                        breaker.record_failure()
                         retry_attempts += 1
-                        print(f"Error during re-run of Step {dep_step}: {e}. Retry attempt {retry_attempts} of {self.max_retries}.")
-                        if retry_attempts >= self.max_retries:
-                            print(f"Max retry attempts reached for Step {dep_step}. Moving to the next step.")
+                        metrics.registry.counter("step_retries_total", step=dep_step).inc()
+                        log.error(f"Error during re-run of Step {dep_step}: {e}. Retry attempt {retry_attempts} of {policy.max_retries}.")
+                        if retry_attempts >= policy.max_retries:
+                            log.warning(f"Max retry attempts reached for Step {dep_step}. Moving to the next step.")
                             raise  # Max retries reached, stop retrying
                         else:
-                            time.sleep(2)  # Add a small delay before retrying
+                            # Backoff with jitter. This runner has one order and nothing else to do
+                            # meanwhile, so it sleeps; the batch engine schedules retries on a TimerWheel.
+                            time.sleep(self.retry_policies.retry_delay(dep_step, retry_attempts))
 
 
     def run_step(self, step):
         """Run a single step."""
-        print(f"Processing Step {step}...")
+        log.info(f"Processing Step {step}...")
         try:
-            success = order_processing_logic.process_step(step)
+            with metrics.registry.timer("step_latency_seconds", step=step):
+                success = order_processing_logic.process_step(step)
             if success:
-                self.state[f"step_{step}_completed"] = True  # Mark as completed
-                save_state(self.state)
-                print(f"Step {step} completed successfully!")
+                self.mark_completed(step)
+                log.info(f"Step {step} completed successfully!")
             else:
                 raise Exception(f"Step {step} failed.")
         except Exception as e:
-            print(f"Error: {e}. Resolve the issue and press Enter to continue.")
+            self.invalidate(step)
+            if self.unattended:
+                self.park(e, step)
+                return
+            log.error(f"Error: {e}. Resolve the issue and press Enter to continue.")
+            self.checkpoint.flush()  # Don't leave progress uncommitted while waiting on the operator
             input("Press Enter to resume...")  # Wait for user to resolve the issue
             self.state["retry_count"] += 1
+            metrics.registry.counter("step_retries_total", step=step).inc()
             if self.state["retry_count"] > self.max_retries:
-                print(f"Maximum retries reached for Step {step}. Skipping to the next step.")
+                log.warning(f"Maximum retries reached for Step {step}. Skipping to the next step.")
                 self.state["step"] += 1
                 self.state["retry_count"] = 0
-            save_state(self.state)
+            self.save_state()
             self.retry_step_with_dependencies(step)  # Retry the failed step and its dependencies
 
+    def park(self, error, step=None):
+        """Park the order for an operator instead of blocking on input()."""
+        step = step or self.state["step"]
+        parking_lot.park(state_store.DEFAULT_ORDER, step, error, self.state)
+        self.save_state()
+        self.checkpoint.flush()
+        log.error(f"Error: {error}. Order parked at Step {step}; "
+                  f"release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' and run again.")
+
+    def is_parked(self):
+        if self.unattended and parking_lot.is_parked(state_store.DEFAULT_ORDER):
+            log.warning(f"Order is parked; release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' first.")
+            return True
+        if parking_lot.resume(self.state):
+            self.save_state()  # Released by an operator; retries start afresh
+        return False
+
     def run(self):
+        if self.is_parked():
+            return
+        try:
+            self.process()
+        finally:
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+
+    def process(self):
         while self.state["step"] <= self.max_steps:
+            if self.state["completed_mask"] & order_processing_logic.registry.bit(self.state["step"]):
+                self.state["step"] += 1  # Already completed by a retry of a later step
+                self.state["retry_count"] = 0
+                self.save_state()
+                continue
             try:
-                print(f"Processing Step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries})...")
+                log.info(f"Processing Step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries})...")
                 self.reload_task_logic()  # Reload the task logic dynamically
 
                 # Run the task logic for the current step
-                success = order_processing_logic.process_step(self.state["step"])
+                with metrics.registry.timer("step_latency_seconds", step=self.state["step"]):
+                    success = order_processing_logic.process_step(self.state["step"])
 
                 if success:
+                    self.state["completed_mask"] |= order_processing_logic.registry.bit(self.state["step"])
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
-                    save_state(self.state)
-                    print(f"Step {self.state['step'] - 1} completed successfully!")
+                    self.save_state()
+                    log.info(f"Step {self.state['step'] - 1} completed successfully!")
 
             except Exception as e:
-                print(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.invalidate(self.state["step"])
+                if self.unattended:
+                    self.park(e)
+                    return
+                log.error(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.checkpoint.flush()
                 input("Press Enter to resume...")  # Wait for user to resolve the issue
                 self.state["retry_count"] += 1
+                metrics.registry.counter("step_retries_total", step=self.state["step"]).inc()
 
                 if self.state["retry_count"] > self.max_retries:
-                    print(f"Maximum retries reached for Step {self.state['step']}. Skipping to the next step.")
+                    log.warning(f"Maximum retries reached for Step {self.state['step']}. Skipping to the next step.")
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
 
-                save_state(self.state)
+                self.save_state()
                 self.retry_step_with_dependencies(self.state["step"])  # Automatically retry the current step and its dependencies
 
-        print("Order processing completed successfully!")
+        metrics.registry.counter("orders_completed_total").inc()
+        log.info("Order processing completed successfully!")
+
+    def run_parallel(self, max_workers=4, executor="thread"):
+        """Run steps on a pool, starting each step as soon as its dependencies complete."""
+        if self.is_parked():
+            return
+        try:
+            self.process_parallel(max_workers, executor)
+        finally:
+            self.checkpoint.close()
+
+    def process_parallel(self, max_workers, executor):
+        limiter = StepLimiter(order_processing_logic.registry.rate_limits())
+        scheduler = DagScheduler(self.get_dependencies, max_workers, executor, limiter)
+        steps = range(1, self.max_steps + 1)
+
+        def mark_completed(step):
+            self.mark_completed(step)
+            log.info(f"Step {step} completed successfully!")
+
+        while True:
+            self.reload_task_logic()  # Reload the task logic dynamically
+            registry = order_processing_logic.registry
+            done = registry.steps_in(self.state["completed_mask"] | self.state["skipped_mask"])
+            failed = scheduler.run(steps, order_processing_logic.process_step, done, mark_completed)
+            if not failed:
+                break
+            for step in failed:
+                self.invalidate(step)
+
+            if self.unattended:
+                step, e = min(failed.items())
+                self.park(e, step)
+                return
+
+            for step, e in sorted(failed.items()):
+                log.error(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.checkpoint.flush()
+                input("Press Enter to resume...")  # Wait for user to resolve the issue
+                self.state["retry_count"] += 1
+                metrics.registry.counter("step_retries_total", step=step).inc()
+                if self.state["retry_count"] > self.max_retries:
+                    log.warning(f"Maximum retries reached for Step {step}. Skipping to the next step.")
+                    self.state["skipped_mask"] |= registry.bit(step)  # Unblocks the steps that depend on it
+                    self.state["retry_count"] = 0
+                self.save_state()
+
+        self.state["step"] = self.max_steps + 1
+        self.save_state()
+        metrics.registry.counter("orders_completed_total").inc()
+        log.info("Order processing completed successfully!")
 
 if __name__ == "__main__":
-    order_processor = OrderProcessingWithDependencies()
-    order_processor.run()
+    parser = argparse.ArgumentParser(description="Process an order, honouring step dependencies.")
+    parser.add_argument("--parallel", action="store_true", help="run independent steps concurrently")
+    parser.add_argument("--workers", type=int, default=4, help="pool size for --parallel")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread", help="pool type for --parallel")
+    parser.add_argument("--unattended", action="store_true", help="park the order on failure instead of prompting")
+    parser.add_argument("--checkpoint", default="step",
+                        help="when to commit state: step (default), N transitions, Tms, exit, or e.g. 10,250ms")
+    args = parser.parse_args()
+
+    exit_on_signals()
+    order_processor = OrderProcessingWithDependencies(args.unattended, checkpoint=args.checkpoint)
+    if args.parallel:
+        order_processor.run_parallel(args.workers, args.executor)
+    else:
+        order_processor.run()
@@ -1,35 +1,45 @@
 import random  # To simulate random failures
+from step_registry import StepRegistry
+
+registry = StepRegistry()
+
+@registry.step(1, "verify_payment", timeout=30)
+def verify_payment():
+    print("Verifying payment...")
+    # if random.choice([True, False]):  # Simulate random failure
+    #     raise Exception("Payment verification failed.")
+    return True
+
+@registry.step(2, "prepare_shipment", depends_on=["verify_payment"])
+def prepare_shipment():
+    print("Preparing items for shipment...")
+    # if random.choice([True, False]):  # Simulate random failure
+    #     raise Exception("Inventory issue encountered.")
+    return True
+
+@registry.step(3, "generate_invoice", depends_on=["verify_payment", "prepare_shipment"])
+def generate_invoice():
+    print("Generating invoice...")
+    # if random.choice([True, False]):  # Simulate random failure
+    #     raise Exception("Failed to generate invoice.")
+    return True
+
+@registry.step(4, "update_inventory", depends_on=["verify_payment", "generate_invoice"])
+def update_inventory():
+    print("Updating inventory...")
+    # if random.choice([True, False]):  # Simulate random failure
+    #     raise Exception("Failed to update inventory.")
+    return True
+
+@registry.step(5, "send_confirmation", depends_on=["verify_payment", "prepare_shipment", "generate_invoice", "update_inventory"])
+def send_confirmation():
+    print("Sending shipment confirmation...")
+    # if random.choice([True, False]):  # Simulate random failure
+    #     raise Exception("Shipping confirmation failed.")
+    return True
+
+registry.compile()  # Validate the steps and build the dispatch table once, at import
 
 def process_step(step):
     """Process a specific step in the order processing."""
-    if step == 1:
-        print("Verifying payment...")
-        # if random.choice([True, False]):  # Simulate random failure
-        #     raise Exception("Payment verification failed.")
-        return True
-    
-    elif step == 2:
-        print("Preparing items for shipment...")
-        # if random.choice([True, False]):  # Simulate random failure
-        #     raise Exception("Inventory issue encountered.")
-        return True
-    
-    elif step == 3:
-        print("Generating invoice...")
-        # if random.choice([True, False]):  # Simulate random failure
-        #     raise Exception("Failed to generate invoice.")
-        return True
-    
-    elif step == 4:
-        print("Updating inventory...")
-        # if random.choice([True, False]):  # Simulate random failure
-        # raise Exception("Failed to update inventory.")
-        return True
-    
-    elif step == 5:
-        print("Sending shipment confirmation...")
-        # if random.choice([True, False]):  # Simulate random failure
-        #     raise Exception("Shipping confirmation failed.")
-        return True
-
-    return False
+    return registry.process_step(step)
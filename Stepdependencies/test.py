@@ -1,15 +1,49 @@
-import pickle
+import os
+import sys
+import argparse
 from pprint import pprint  # For pretty printing large or nested data
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
 
-# Specify the path to your .pkl file
-file_path = "C:/Users/dell/Desktop/task/order_state.pkl"
-
-# Load and display the .pkl file content
-try:
-    with open(file_path, "rb") as file:
-        data = pickle.load(file)
-    print("Type of data:", type(data))
-    print("\nContent:")
-    pprint(data)
-except Exception as e:
-    print("Error while reading the .pkl file:", e)
+# Query saved order state.
+#
+#   python test.py orders.db --step 3 --min-retries 3   # orders stuck at step 3 with retry_count > 2
+#   python test.py orders.db --parked                    # parked orders, with the retry_count they failed at
+#   python test.py orders.db --summary                   # unfinished orders per step
+#   python test.py order_state.pkl                       # dump a pickle/journal state file
+
+def print_rows(rows):
+    print(f"{'order_id':<20} {'step':>4} {'retries':>7} {'completed':>9} {'done':>4} {'reval':>5} {'parked':>6}")
+    for order_id, step, retry_count, mask, done, needs_revalidation, parked, _ in rows:
+        print(f"{order_id:<20} {step:>4} {retry_count:>7} {mask:>9b} {done:>4} {needs_revalidation:>5} {parked:>6}")
+    print(f"{len(rows)} orders")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect saved order state.")
+    parser.add_argument("path", nargs="?", default="order_state.pkl", help="state file (.db/.sqlite, .mmap or pickle)")
+    parser.add_argument("--order", help="show the full state of one order")
+    parser.add_argument("--step", type=int, help="orders currently at this step")
+    parser.add_argument("--min-retries", type=int, help="orders with at least this many retries")
+    parser.add_argument("--completed", type=int, help="orders that have completed this step")
+    parser.add_argument("--done", action="store_true", default=None, help="finished orders only")
+    parser.add_argument("--pending", dest="done", action="store_false", help="unfinished orders only")
+    parser.add_argument("--needs-revalidation", action="store_true", default=None, help="orders flagged for revalidation")
+    parser.add_argument("--parked", action="store_true", default=None, help="parked orders only")
+    parser.add_argument("--limit", type=int, help="maximum number of orders to list")
+    parser.add_argument("--summary", action="store_true", help="count unfinished orders per step")
+    args = parser.parse_args()
+
+    try:
+        store = state_store.open_store(args.path)
+        if args.order:
+            pprint(store.load(args.order))
+        elif not hasattr(store, "query"):
+            pprint(store.load_all())  # Pickle, journal and mmap stores can only be dumped
+        elif args.summary:
+            for step, count in sorted(store.count_by_step().items()):
+                print(f"Step {step}: {count} orders")
+        else:
+            print_rows(store.query(args.step, args.min_retries, args.done, args.needs_revalidation,
+                                   args.completed, args.limit, args.parked))
+    except Exception as e:
+        print("Error while reading the state file:", e)
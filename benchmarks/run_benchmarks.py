@@ -0,0 +1,351 @@
+"""Benchmark the order runners against synthetic workloads.
+
+Each runner is driven headless (unattended, so failures park the order
+instead of prompting) against a generated order_processing_logic/task_logic
+module whose step latencies and failure rates come from the command line:
+
+    python benchmarks/run_benchmarks.py task_processor stepdependencies \\
+        --orders 200 --latency exp:0.002 --latency 3=uniform:0.01:0.02 \\
+        --failure 0.01 --failure 4=0.05
+
+Latency distributions are fixed:S, uniform:A:B, exp:MEAN and
+lognormal:MEDIAN:SIGMA (seconds); a STEP= prefix applies one to a single
+step. Every runner runs in its own process and scratch directory, so the
+real state files and parked-order lists are never touched.
+
+For each runner the harness reports orders/sec, p50/p99 completion latency,
+state-store bytes written and hot-reload overhead. --save-baseline records
+the results in baselines.json, keyed by runner and workload; later runs of
+the same workload are compared against it, and --check exits non-zero when
+a number regressed by more than --tolerance.
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+class Runner:
+    """Where a runner lives and how to drive it."""
+
+    def __init__(self, directory, module, cls, state_file, method="run", batch=False):
+        self.directory = directory
+        self.module = module
+        self.cls = cls
+        self.state_file = state_file
+        self.method = method
+        self.batch = batch
+
+RUNNERS = {
+    "task_processor": Runner("Order_processing", "task_processor", "OrderProcessingWithRetry", "order_state.pkl"),
+    "stepdependencies": Runner("Stepdependencies", "main", "OrderProcessingWithDependencies", "order_state.pkl"),
+    "stepdependencies_parallel": Runner("Stepdependencies", "main", "OrderProcessingWithDependencies", "order_state.pkl",
+                                        method="run_parallel"),
+    "rerun": Runner("rerun", "main", "OrderProcessingWithRetry", "order_state.pkl"),
+    "revalidation": Runner("Revalidation", "revald", "TaskWithDependencyHandling", "state.pkl"),
+    "batch": Runner("Order_processing", "batch_processor", "BatchOrderProcessing", "batch_state.pkl", batch=True),
+}
+
+LOGIC_TEMPLATE = '''"""Synthetic step logic generated by benchmarks/run_benchmarks.py."""
+import math
+import random
+import time
+
+LATENCY = {latency!r}  # step -> (distribution, params); step 0 is the default
+FAILURE = {failure!r}  # step -> failure probability; step 0 is the default
+
+def sample_latency(step):
+    kind, params = LATENCY.get(step, LATENCY[0])
+    if kind == "fixed":
+        return params[0]
+    if kind == "uniform":
+        return random.uniform(*params)
+    if kind == "exp":
+        return random.expovariate(1 / params[0]) if params[0] else 0.0
+    return random.lognormvariate(math.log(params[0]), params[1])
+
+def process_step(step):
+    time.sleep(sample_latency(step))
+    if random.random() < FAILURE.get(step, FAILURE[0]):
+        raise Exception(f"Synthetic failure at Step {{step}}")
+    return True
+
+class TaskLogic:
+    @staticmethod
+    def run_step(step_number):
+        return process_step(step_number)
+'''
+
+REGISTRY_TEMPLATE = '''
+from functools import partial
+from step_registry import StepRegistry
+
+registry = StepRegistry()
+for number in range(1, {steps} + 1):
+    registry.register(number, f"step_{{number}}", partial(process_step, number),
+                      depends_on=[number - 1] if number > 1 else [])
+registry.compile()
+'''
+
+DISTRIBUTIONS = {"fixed": 1, "uniform": 2, "exp": 1, "lognormal": 2}
+
+def parse_step_option(spec):
+    """Split "3=value" into (3, "value"); a bare "value" applies to every step (0)."""
+    step, sep, value = spec.partition("=")
+    if not sep:
+        return 0, spec
+    return int(step), value
+
+def parse_latency(spec):
+    kind, *params = spec.split(":")
+    if DISTRIBUTIONS.get(kind) != len(params):
+        raise ValueError(f"Bad latency distribution: {spec}")
+    params = tuple(float(p) for p in params)
+    if kind == "lognormal" and params[0] <= 0:
+        raise ValueError(f"lognormal median must be positive: {spec}")
+    return kind, params
+
+def write_logic(directory, workload, revision=0):
+    """Write the synthetic logic as order_processing_logic.py (with a step registry) and task_logic.py."""
+    source = LOGIC_TEMPLATE.format(latency=workload["latency"], failure=workload["failure"])
+    footer = f"\n# Revision {revision}\n"
+    with open(os.path.join(directory, "order_processing_logic.py"), "w") as f:
+        f.write(source + REGISTRY_TEMPLATE.format(steps=workload["steps"]) + footer)
+    with open(os.path.join(directory, "task_logic.py"), "w") as f:
+        f.write(source + footer)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))]
+
+def disk_usage(directory, prefix):
+    """Bytes on disk for the files of a state store (snapshot, journal, WAL, ...)."""
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for name in os.listdir(directory) if name.startswith(prefix))
+
+def bytes_written(state_store, directory, state_file):
+    store = state_store.open_store(state_file)
+    return store.bytes_written or disk_usage(directory, state_file)  # SQLite doesn't count its own writes
+
+def run_worker(workload, runner_name, workdir):
+    """Run one runner over the workload inside workdir and return its numbers."""
+    import random
+
+    runner = RUNNERS[runner_name]
+    logic_dir = os.path.join(workdir, "logic")
+    os.makedirs(logic_dir)
+    write_logic(logic_dir, workload)
+    sys.path[:0] = [logic_dir, os.path.join(REPO, runner.directory), os.path.join(REPO, "common")]
+    random.seed(workload["seed"])
+
+    module = importlib.import_module(runner.module)
+    state_store = importlib.import_module("state_store")
+    metrics = importlib.import_module("metrics")
+    orders = workload["orders"]
+    latencies = []
+    written = 0
+    completed = 0
+
+    start = time.perf_counter()
+    if runner.batch:
+        from retry_policy import RetryPolicies, RetryPolicy
+
+        os.chdir(workdir)
+        policies = RetryPolicies(RetryPolicy(workload["max_retries"], workload["retry_delay"], workload["retry_delay"] * 8))
+        engine = getattr(module, runner.cls)([f"order-{i}" for i in range(orders)], runner.state_file, policies)
+        unfinished = set(engine.orders)
+        next_touch = workload["touch_every"]
+        while engine.run_pass() or engine.waiting:  # BatchOrderProcessing.run(), timing each order
+            done = {order_id for order_id in unfinished if engine.orders[order_id]["step"] > engine.max_steps}
+            latencies.extend([time.perf_counter() - start] * len(done))
+            unfinished -= done
+            if next_touch and len(latencies) >= next_touch:
+                write_logic(logic_dir, workload, len(latencies))
+                next_touch += workload["touch_every"]
+            if not engine.pending_by_step():
+                time.sleep(engine.retry_wheel.tick)
+        completed = len(latencies)
+        written = bytes_written(state_store, workdir, runner.state_file)
+    else:
+        for i in range(orders):
+            if workload["touch_every"] and i and i % workload["touch_every"] == 0:
+                write_logic(logic_dir, workload, i)  # Forces the next reload to re-import
+            order_dir = os.path.join(workdir, f"order-{i}")
+            os.makedirs(order_dir)
+            os.chdir(order_dir)  # Fresh state file and parking lot per order
+            order_start = time.perf_counter()
+            processor = getattr(module, runner.cls)(unattended=True)
+            getattr(processor, runner.method)()
+            if processor.state["step"] > processor.max_steps:
+                latencies.append(time.perf_counter() - order_start)
+                completed += 1
+            written += bytes_written(state_store, order_dir, runner.state_file)
+            state_store.close_stores()
+            os.chdir(workdir)
+            shutil.rmtree(order_dir)
+    elapsed = time.perf_counter() - start
+
+    reloads = metrics.registry.histogram("logic_reload_seconds")
+    retries = sum(c.value for (name, _), c in metrics.registry.counters.items() if name == "step_retries_total")
+    return {
+        "orders": orders,
+        "completed": completed,
+        "parked": orders - completed,
+        "retries": retries,
+        "seconds": elapsed,
+        "orders_per_second": completed / elapsed if elapsed else 0.0,
+        "p50_seconds": percentile(latencies, 0.50),
+        "p99_seconds": percentile(latencies, 0.99),
+        "bytes_written": written,
+        "bytes_per_order": written / orders if orders else 0,
+        "reload_count": reloads.count,
+        "reload_seconds": reloads.sum,
+        "reload_share": reloads.sum / elapsed if elapsed else 0.0,
+    }
+
+def run_runner(workload, runner_name, verbose=False, keep=False):
+    """Run a runner in a child process and scratch directory; return its results."""
+    workdir = tempfile.mkdtemp(prefix=f"bench-{runner_name}-")
+    result_file = os.path.join(workdir, "result.json")
+    env = dict(os.environ, ORDER_METRICS="", ORDER_LOG_LEVEL=os.environ.get("ORDER_LOG_LEVEL", "ERROR"))
+    command = [sys.executable, os.path.abspath(__file__), "--worker", runner_name,
+               "--workload", json.dumps(workload), "--workdir", workdir, "--result", result_file]
+    try:
+        subprocess.run(command, env=env, check=True, stdout=None if verbose else subprocess.DEVNULL)
+        with open(result_file) as f:
+            return json.load(f)
+    finally:
+        if keep:
+            print(f"Kept scratch directory {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def workload_key(runner_name, workload):
+    digest = hashlib.sha256(json.dumps(workload, sort_keys=True).encode()).hexdigest()[:12]
+    return f"{runner_name}/{digest}"
+
+def load_baselines(filename=BASELINE_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_baselines(baselines, filename=BASELINE_FILE):
+    tmp = f"{filename}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, filename)
+
+# metric -> True if bigger is better
+COMPARED = {"orders_per_second": True, "p50_seconds": False, "p99_seconds": False,
+            "bytes_per_order": False, "reload_share": False}
+
+def regressions(result, baseline, tolerance):
+    """Return [(metric, baseline value, new value)] for the metrics that got worse by more than tolerance."""
+    worse = []
+    for metric, higher_is_better in COMPARED.items():
+        old, new = baseline["result"][metric], result[metric]
+        if not old:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            worse.append((metric, old, new))
+    return worse
+
+def report(runner_name, result):
+    print(f"{runner_name}: {result['completed']}/{result['orders']} orders completed "
+          f"({result['parked']} parked, {result['retries']} retries) in {result['seconds']:.2f}s")
+    print(f"  {result['orders_per_second']:.1f} orders/sec, "
+          f"p50 {result['p50_seconds'] * 1000:.1f}ms, p99 {result['p99_seconds'] * 1000:.1f}ms")
+    print(f"  state store: {result['bytes_written']} bytes written ({result['bytes_per_order']:.0f} per order)")
+    print(f"  logic reloads: {result['reload_count']} checks, {result['reload_seconds'] * 1000:.1f}ms "
+          f"({result['reload_share']:.1%} of wall time)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the order runners against synthetic workloads.")
+    parser.add_argument("runners", nargs="*", metavar="runner",
+                        help=f"runners to benchmark (default: all of {', '.join(sorted(RUNNERS))})")
+    parser.add_argument("--orders", type=int, default=100, help="orders per runner")
+    parser.add_argument("--steps", type=int, default=5,
+                        help="steps in the synthetic pipeline, each depending on the one before (not revalidation)")
+    parser.add_argument("--latency", action="append", default=[], metavar="[STEP=]DIST",
+                        help="step latency distribution (default exp:0.001)")
+    parser.add_argument("--failure", action="append", default=[], metavar="[STEP=]RATE",
+                        help="probability that a step fails (default 0)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic logic")
+    parser.add_argument("--touch-every", type=int, default=0, metavar="N",
+                        help="rewrite the logic module every N orders to exercise hot reload")
+    parser.add_argument("--retry-delay", type=float, default=0.01, help="base retry delay for the batch runner")
+    parser.add_argument("--max-retries", type=int, default=3, help="retries before the batch runner parks an order")
+    parser.add_argument("--baseline-file", default=BASELINE_FILE, help="where baselines are kept")
+    parser.add_argument("--save-baseline", action="store_true", help="record these results as the baseline")
+    parser.add_argument("--check", action="store_true", help="exit non-zero if a runner regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before --check fails")
+    parser.add_argument("--verbose", action="store_true", help="show the runners' own output")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directories")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--workload", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_worker(json.loads(args.workload, object_hook=lambda d: {int(k) if k.isdigit() else k: v for k, v in d.items()}),
+                            args.worker, args.workdir)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        sys.exit()
+
+    unknown = set(args.runners) - set(RUNNERS)
+    if unknown:
+        parser.error(f"unknown runners: {', '.join(sorted(unknown))}")
+    try:
+        latency = {0: ("exp", (0.001,))}
+        for spec in args.latency:
+            step, value = parse_step_option(spec)
+            latency[step] = parse_latency(value)
+        failure = {0: 0.0}
+        for spec in args.failure:
+            step, value = parse_step_option(spec)
+            failure[step] = float(value)
+    except ValueError as e:
+        parser.error(str(e))
+
+    workload = {"orders": args.orders, "steps": args.steps, "latency": latency, "failure": failure, "seed": args.seed,
+                "touch_every": args.touch_every, "retry_delay": args.retry_delay, "max_retries": args.max_retries}
+    workload = json.loads(json.dumps(workload))  # Same shape as the worker and baseline file see
+    baselines = load_baselines(args.baseline_file)
+    regressed = False
+    for runner_name in args.runners or sorted(RUNNERS):
+        result = run_runner(workload, runner_name, args.verbose, args.keep)
+        report(runner_name, result)
+        key = workload_key(runner_name, workload)
+        baseline = baselines.get(key)
+        if baseline:
+            worse = regressions(result, baseline, args.tolerance)
+            for metric, old, new in worse:
+                print(f"  REGRESSION {metric}: {old:.4g} -> {new:.4g}")
+            if not worse:
+                print(f"  within {args.tolerance:.0%} of the baseline from {baseline['recorded']}")
+            regressed = regressed or bool(worse)
+        if args.save_baseline:
+            baselines[key] = {"recorded": time.strftime("%Y-%m-%d %H:%M:%S"), "workload": workload, "result": result}
+
+    if args.save_baseline:
+        save_baselines(baselines, args.baseline_file)
+        print(f"Baselines saved to {args.baseline_file}")
+    if args.check and regressed:
+        sys.exit(1)
@@ -0,0 +1,135 @@
+import signal
+import sys
+import threading
+import metrics
+from state_store import DEFAULT_ORDER
+
+class CheckpointPolicy:
+    """Decide when a runner's saved state is committed to its store.
+
+    Runners hand every state transition to save() instead of saving and
+    committing themselves. The policy commits the store:
+
+        every=1          after every transition (the runners' old behaviour)
+        every=N          once N transitions are pending
+        interval=T       from a background thread, T seconds after the oldest
+                         pending transition
+        on_boundary      at the runner's natural boundaries, via boundary():
+                         the end of a batch pass
+        (none of these)  only on flush() and close(), i.e. on shutdown
+
+    every and interval can be combined; whichever comes first commits. Any
+    policy also commits on flush() and close(), and runners flush before
+    parking an order or prompting an operator.
+
+    Durability contract. A transition is durable once the commit that
+    follows it returns. After a crash (kill -9, power loss) the runner
+    resumes from the last commit, so a step that completed after it runs
+    again: at most N-1 transitions per runner with every=N, the transitions
+    of the last T seconds (plus one commit's duration) with interval=T, and
+    the current pass with on_boundary. The step that was executing at the
+    crash always re-runs, under any policy. SIGINT, and SIGTERM/SIGHUP once
+    exit_on_signals() is installed, end the runner through close(), so a
+    clean shutdown loses nothing. Only steps that are safe to repeat should
+    run under anything but every=1. "Durable" means what the store's commit()
+    means: the journal and mmap stores reach the OS page cache, and survive
+    power loss only when opened with fsync.
+
+    The store may still write on its own sooner (a journal's group_size);
+    the policy only bounds how long a transition can stay uncommitted.
+    save() and the flusher thread share a lock, so stores need not be
+    thread-safe.
+    """
+
+    def __init__(self, store, every=1, interval=None, on_boundary=False):
+        self.store = store
+        self.every = every
+        self.interval = interval
+        self.on_boundary = on_boundary
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()  # Set while transitions are pending, for the flusher
+        self.closed = threading.Event()
+        self.flusher = None
+        if interval:
+            self.flusher = threading.Thread(target=self.flush_periodically, name="checkpoint-flusher", daemon=True)
+            self.flusher.start()
+
+    @classmethod
+    def parse(cls, spec, store):
+        """Build a policy from a command-line spec.
+
+        "step" commits after every transition, "pass" at the end of each
+        batch pass, "exit" only on shutdown; a number commits every N
+        transitions and "250ms" every 250 milliseconds. Combine a count and
+        an interval with a comma: "100,250ms".
+        """
+        every, interval, on_boundary = None, None, False
+        for part in spec.split(","):
+            part = part.strip()
+            if part == "step":
+                every = 1
+            elif part == "pass":
+                on_boundary = True
+            elif part == "exit":
+                pass
+            elif part.endswith("ms"):
+                interval = float(part[:-2]) / 1000
+            elif part.isdigit() and int(part) > 0:
+                every = int(part)
+            else:
+                raise ValueError(f"Unknown checkpoint policy {part!r}; "
+                                 f"use step, pass, exit, a transition count or an interval like 250ms")
+        return cls(store, every, interval, on_boundary)
+
+    def save(self, state, order_id=DEFAULT_ORDER):
+        """Record one state transition, committing it if the policy says so."""
+        with self.lock:
+            self.store.save(state, order_id)
+            self.pending += 1
+            if self.every and self.pending >= self.every:
+                self.commit()
+            else:
+                self.dirty.set()
+
+    def boundary(self):
+        """Called by runners at a natural commit point, e.g. the end of a pass."""
+        if self.on_boundary:
+            self.flush()
+
+    def commit(self):
+        """Commit the store. The caller holds the lock."""
+        with metrics.registry.timer("state_save_seconds"):
+            self.store.commit()
+        metrics.registry.counter("checkpoints_total").inc()
+        self.pending = 0
+        self.dirty.clear()
+
+    def flush(self):
+        """Commit every pending transition now."""
+        with self.lock:
+            if self.pending:
+                self.commit()
+
+    def flush_periodically(self):
+        while not self.closed.is_set():
+            self.dirty.wait()
+            if self.closed.wait(self.interval):
+                return
+            self.flush()
+
+    def close(self):
+        """Stop the flusher thread and commit what is left. Safe to call more than once."""
+        self.closed.set()
+        self.dirty.set()  # Wake the flusher so it sees closed
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+
+def exit_on_signals(signals=(signal.SIGTERM, signal.SIGHUP)):
+    """Turn termination signals into SystemExit, so a runner's finally blocks (and close()) run."""
+    def handler(signum, frame):
+        sys.exit(128 + signum)
+
+    for signum in signals:
+        signal.signal(signum, handler)
@@ -0,0 +1,77 @@
+"""Advisory file locks: fcntl on POSIX, msvcrt.locking on Windows, none (with a warning) elsewhere."""
+import time
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:  # Anything but Windows
+    msvcrt = None
+
+log = metrics.get_logger("file_lock")
+warned = False
+
+def no_locking():
+    """Neither fcntl nor msvcrt is available: carry on unlocked, saying so once."""
+    global warned
+    if not warned:
+        log.warning("No file locking on this platform; don't run two runners on the same state files.")
+        warned = True
+    return True
+
+def msvcrt_locking(file, start, length, mode):
+    """msvcrt.locking locks from the file position, so seek there and back."""
+    position = file.tell()
+    file.seek(start)
+    try:
+        msvcrt.locking(file.fileno(), mode, length)
+    finally:
+        file.seek(position)
+
+def msvcrt_lock(file, start, length, blocking, poll=0.01):
+    while True:
+        try:
+            msvcrt_locking(file, start, length, msvcrt.LK_NBLCK)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(poll)  # LK_LOCK gives up after ten seconds; keep waiting like fcntl does
+
+def lock_range(file, start, length, blocking=True):
+    """Take an exclusive lock on length bytes of an open file from start.
+
+    Returns False if another process holds any of them and blocking=False.
+    POSIX record locks (fcntl.lockf) belong to the process; on Windows the
+    range is locked with msvcrt.locking instead.
+    """
+    if fcntl is None:
+        return msvcrt_lock(file, start, length, blocking) if msvcrt else no_locking()
+    try:
+        fcntl.lockf(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, length, start)
+    except (BlockingIOError, PermissionError):
+        return False  # Held by another process
+    return True
+
+def unlock_range(file, start, length):
+    if fcntl is not None:
+        fcntl.lockf(file, fcntl.LOCK_UN, length, start)
+    elif msvcrt:
+        msvcrt_locking(file, start, length, msvcrt.LK_UNLCK)
+
+def lock_file(file, blocking=True):
+    """Take an exclusive lock on a whole open file: flock, so it is held per open file, not per process.
+
+    Returns False if it is held elsewhere and blocking=False. Closing the
+    file releases the lock.
+    """
+    if fcntl is None:
+        return msvcrt_lock(file, 0, 1, blocking) if msvcrt else no_locking()
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
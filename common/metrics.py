@@ -0,0 +1,230 @@
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge:
+    """A value that goes up and down, e.g. how many calls are queued."""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+class PrometheusTextSink:
+    """Write the registry to a Prometheus text-format file (for the node exporter's textfile collector)."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def export(self, registry):
+        lines = []
+        for (name, labels), counter in sorted(registry.counters.items()):
+            lines.append(f"{name}{format_labels(labels)} {counter.value}")
+        for (name, labels), value in sorted(registry.gauges().items()):
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(registry.histograms.items()):
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {total}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.filename)  # Scrapers never see a half-written file
+
+class JsonLinesSink:
+    """Append one JSON snapshot of the registry per export."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def export(self, registry):
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(registry.snapshot()) + "\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Registry:
+    """In-process metrics registry.
+
+    Metrics are keyed by name and labels, e.g.
+    registry.histogram("step_latency_seconds", step=3). export() pushes the
+    current values to every configured sink; maybe_export() does so at most
+    once per export_interval seconds, so it is cheap to call on the hot path.
+    """
+
+    def __init__(self, sinks=(), export_interval=10.0):
+        self.counters = {}
+        self.gauge_values = {}
+        self.histograms = {}
+        self.sinks = list(sinks)
+        self.export_interval = export_interval
+        self.started = time.monotonic()
+        self.last_export = self.started
+
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = Counter()
+        return counter
+
+    def gauge(self, name, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        gauge = self.gauge_values.get(key)
+        if gauge is None:
+            gauge = self.gauge_values[key] = Gauge()
+        return gauge
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the with-block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name, **labels).observe(time.perf_counter() - start)
+
+    def gauges(self):
+        """The gauges' current values, plus orders completed per second since start, derived at export time."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        completed = sum(c.value for (name, _), c in self.counters.items() if name == "orders_completed_total")
+        values = {key: gauge.value for key, gauge in self.gauge_values.items()}
+        values[("orders_per_second", ())] = completed / elapsed
+        return values
+
+    def snapshot(self):
+        def key(name, labels):
+            return name + format_labels(labels)
+
+        return {
+            "time": time.time(),
+            "counters": {key(*k): c.value for k, c in self.counters.items()},
+            "gauges": {key(*k): v for k, v in self.gauges().items()},
+            "histograms": {key(*k): {"count": h.count, "sum": h.sum,
+                                     "buckets": {str(b): n for b, n in h.cumulative()}}
+                           for k, h in self.histograms.items()},
+        }
+
+    def add_sink(self, spec):
+        """Add a sink from a "prometheus:<file>" or "jsonl:<file>" spec."""
+        kind, _, filename = spec.partition(":")
+        if kind == "prometheus":
+            self.sinks.append(PrometheusTextSink(filename))
+        elif kind == "jsonl":
+            self.sinks.append(JsonLinesSink(filename))
+        else:
+            raise ValueError(f"Unknown metrics sink: {spec}")
+
+    def export(self):
+        self.last_export = time.monotonic()
+        for sink in self.sinks:
+            sink.export(self)
+
+    def maybe_export(self):
+        if self.sinks and time.monotonic() - self.last_export >= self.export_interval:
+            self.export()
+
+class FieldsFormatter(logging.Formatter):
+    """Plain message followed by any structured fields passed as extra={"fields": {...}}."""
+
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry)
+
+def get_logger(name):
+    """Buffered logger for the runners.
+
+    Records are held in memory and written in batches of ORDER_LOG_BUFFER
+    (default 256) records, immediately for WARNING and above, and on
+    flush_logs(). The level comes from ORDER_LOG_LEVEL (default INFO) and
+    ORDER_LOG_FORMAT=json switches to one JSON object per line.
+    """
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    console = logging.StreamHandler(sys.stdout)
+    if os.environ.get("ORDER_LOG_FORMAT") == "json":
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(FieldsFormatter("%(message)s"))
+    buffered = logging.handlers.MemoryHandler(int(os.environ.get("ORDER_LOG_BUFFER", 256)),
+                                              flushLevel=logging.WARNING, target=console)
+    logger.addHandler(buffered)
+    logger.setLevel(os.environ.get("ORDER_LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    return logger
+
+def flush_logs(logger):
+    """Write out buffered records, e.g. before prompting the operator."""
+    for handler in logger.handlers:
+        handler.flush()
+
+registry = Registry()
+for spec in filter(None, os.environ.get("ORDER_METRICS", "").split(",")):
+    registry.add_sink(spec)  # e.g. ORDER_METRICS=prometheus:metrics.prom,jsonl:metrics.jsonl
+if registry.sinks:
+    atexit.register(registry.export)  # Final values, however the runner exits
@@ -0,0 +1,324 @@
+import mmap
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+import file_lock
+import order_record
+from state_store import StateStore, DEFAULT_ORDER, detach
+
+MAGIC = b"ORDMMAP1"
+HEADER = struct.Struct("<8sII")  # magic, slot size, capacity in slots
+COUNTER = struct.Struct("<Q")
+GENERATION_OFFSET = HEADER.size  # Bumped whenever a slot is taken or freed
+FREES_OFFSET = GENERATION_OFFSET + COUNTER.size  # Bumped whenever a slot is freed
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<BBHI")  # in use, order_id length, record length, crc32 of order_id + record
+FREE, USED = 0, 1
+
+class MmapStateStore(StateStore):
+    """Memory-mapped file of fixed-size slots, one per order.
+
+    A save encodes the order's OrderRecord straight into its slot, so
+    updating one order touches one slot instead of rewriting the file.
+    Deleted orders' slots go on a free list and are reused; when no slot is
+    free the file doubles in size. commit() flushes the dirty pages to disk
+    (msync), as does every group_size-th save if group_size is given.
+
+    Opening the file maps it and reads only the slot headers and order IDs
+    to rebuild the index and free list, so a large backlog is available
+    without decoding any state. Each slot carries a crc32; a slot torn by a
+    crash in the middle of an update fails the check on open, is reported
+    and freed, and that order's state is lost. Everything committed before
+    the last commit() that completed is intact.
+
+    Any number of processes on one host can share the file. The mapping is
+    shared, so a save is visible to every process as soon as it returns.
+    Taking or freeing a slot happens under a lock on the file header
+    and bumps a generation counter there; a process that sees the counter
+    move catches up before its next lookup, reading the in-use flags of the
+    slots (or every slot header, after a delete) to find what other
+    processes added. Per order, lock() takes a lock on the order's
+    slot: a runner holds it from reading an order's state until it has
+    saved the next one, so no two processes run the same order at once, and
+    a slot that fails its checksum while another process holds its lock is
+    being written, not torn. The locks belong to the process and are
+    released if it dies.
+
+    Orders whose ID and encoded record don't fit in slot_size (minus an
+    8-byte header) raise ValueError; open the store with a larger slot_size.
+    """
+
+    shared = True
+
+    def __init__(self, filename, slot_size=64, capacity=1024, group_size=None):
+        self.filename = filename
+        self.group_size = group_size
+        self.unflushed = 0
+        self.superseded = []  # Mappings of the file before it grew
+        self.file = open(filename, "a+b")  # Create it if missing, never truncate a file another process uses
+        with self.range_locked(0, HEADER_SIZE):
+            if os.path.getsize(filename) >= HEADER_SIZE:
+                self.mm = mmap.mmap(self.file.fileno(), 0)
+                magic, self.slot_size, self.capacity = HEADER.unpack_from(self.mm)
+                if magic != MAGIC:
+                    raise ValueError(f"{filename} is not a memory-mapped state file")
+            else:
+                self.file.truncate(HEADER_SIZE)
+                self.mm = mmap.mmap(self.file.fileno(), 0)
+                self.slot_size, self.capacity = slot_size, 0
+                self.grow(capacity)
+            self.generation, self.frees = self.read_counters()
+            self.index, self.free = self.scan()
+            self.in_use = self.slot_flags()
+
+    def offset(self, slot):
+        return HEADER_SIZE + slot * self.slot_size
+
+    def read_generation(self):
+        return COUNTER.unpack_from(self.mm, GENERATION_OFFSET)[0]
+
+    def read_counters(self):
+        return self.read_generation(), COUNTER.unpack_from(self.mm, FREES_OFFSET)[0]
+
+    def slot_flags(self):
+        return bytearray(self.mm[HEADER_SIZE::self.slot_size][:self.capacity])  # First byte of every slot
+
+    def scan(self):
+        """Rebuild {order_id: slot} and the free list from the slot headers."""
+        index, free = {}, []
+        in_use = self.slot_flags()
+        for slot in range(self.capacity):
+            if in_use[slot] != USED:
+                free.append(slot)
+                continue
+            offset = self.offset(slot)
+            _, key_length, record_length, crc = SLOT_HEADER.unpack_from(self.mm, offset)
+            start = offset + SLOT_HEADER.size
+            body = self.mm[start:start + key_length + record_length]
+            if zlib.crc32(body) != crc and self.lock_range(offset, self.slot_size, blocking=False):
+                self.unlock_range(offset, self.slot_size)  # Nobody is writing it
+                print(f"Discarding slot {slot} of {self.filename}: torn by an interrupted write.")
+                self.mm[offset] = FREE
+                free.append(slot)
+                continue
+            index[body[:key_length].decode()] = slot
+        free.reverse()  # pop() hands out the lowest free slot first
+        return index, free
+
+    # Locking: record locks on byte ranges of the file (fcntl, or msvcrt on Windows)
+
+    def lock_range(self, start, length, blocking=True):
+        return file_lock.lock_range(self.file, start, length, blocking)
+
+    def unlock_range(self, start, length):
+        file_lock.unlock_range(self.file, start, length)
+
+    @contextmanager
+    def range_locked(self, start, length):
+        self.lock_range(start, length)
+        try:
+            yield
+        finally:
+            self.unlock_range(start, length)
+
+    @contextmanager
+    def header_locked(self):
+        """Hold the header lock, with the mapping and index caught up with other processes."""
+        with self.range_locked(0, HEADER_SIZE):
+            self.refresh()
+            yield
+
+    def refresh(self):
+        """Catch up with slots other processes have taken or freed, and with the file growing."""
+        capacity = HEADER.unpack_from(self.mm)[2]
+        if capacity != self.capacity:
+            self.remap()
+            self.free[:0] = reversed(range(self.capacity, capacity))
+            self.capacity = capacity
+        generation, frees = self.read_counters()
+        if frees != self.frees:  # A freed slot may hold another order by now, with its flag unchanged
+            self.generation, self.frees = generation, frees
+            self.index, self.free = self.scan()
+            self.in_use = self.slot_flags()
+        elif generation != self.generation:
+            self.generation = generation
+            self.rescan()
+
+    def rescan(self, chunk=4096):
+        """Index the slots whose in-use flag changed since the last look, comparing the flags a chunk at a time."""
+        in_use, seen = self.slot_flags(), self.in_use
+        for start in range(0, len(in_use), chunk):
+            if in_use[start:start + chunk] == seen[start:start + chunk]:
+                continue
+            for slot in range(start, min(start + chunk, len(in_use))):
+                was = seen[slot] if slot < len(seen) else FREE
+                if in_use[slot] == was:
+                    continue
+                if in_use[slot] == USED:
+                    self.index[self.key_at(slot)] = slot
+                else:
+                    self.free.append(slot)
+        self.in_use = in_use
+
+    def changed(self, slot, flag):
+        """Record that this process took (USED) or freed (FREE) a slot. The caller holds the header lock."""
+        self.generation += 1
+        COUNTER.pack_into(self.mm, GENERATION_OFFSET, self.generation)
+        if flag == FREE:
+            self.frees += 1
+            COUNTER.pack_into(self.mm, FREES_OFFSET, self.frees)
+        if slot >= len(self.in_use):
+            self.in_use.extend(bytes(self.capacity - len(self.in_use)))
+        self.in_use[slot] = flag
+
+    def lock(self, order_id, blocking=True):
+        """Lock an order against other processes. Returns False if it is unknown, or busy and blocking=False."""
+        while True:
+            slot = self.slot_of(order_id)
+            if slot is None:
+                return False
+            if not self.lock_range(self.offset(slot), self.slot_size, blocking):
+                return False
+            if self.read_generation() == self.generation or self.key_at(slot) == order_id:
+                return True
+            self.unlock_range(self.offset(slot), self.slot_size)  # Freed and reused while we waited
+
+    def unlock(self, order_id):
+        slot = self.index.get(order_id)
+        if slot is not None:
+            self.unlock_range(self.offset(slot), self.slot_size)
+
+    def remap(self):
+        """Map the whole file again, after it grew.
+
+        The old mapping stays open until close(): it holds a dup of the file
+        descriptor, and closing any descriptor of the file drops every fcntl
+        lock this process holds on it, the header lock included.
+        """
+        self.superseded.append(self.mm)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    def grow(self, capacity):
+        """Extend the file to hold capacity slots; the new slots are zero, i.e. free. The caller holds the header lock."""
+        self.mm.flush()
+        self.file.truncate(HEADER_SIZE + capacity * self.slot_size)
+        self.remap()
+        HEADER.pack_into(self.mm, 0, MAGIC, self.slot_size, capacity)
+        if hasattr(self, "free"):
+            self.free[:0] = reversed(range(self.capacity, capacity))
+        self.capacity = capacity
+
+    def allocate(self):
+        """Take a free slot. The caller holds the header lock."""
+        while True:
+            if not self.free:
+                self.grow(self.capacity * 2)
+            slot = self.free.pop()
+            if self.mm[self.offset(slot)] == FREE:
+                return slot
+
+    def key_at(self, slot):
+        offset = self.offset(slot)
+        used, key_length, _, _ = SLOT_HEADER.unpack_from(self.mm, offset)
+        if used != USED:
+            return None
+        start = offset + SLOT_HEADER.size
+        return self.mm[start:start + key_length].decode()
+
+    def slot_of(self, order_id):
+        """Return the slot holding order_id, or None, catching up with other processes if need be."""
+        if self.read_generation() != self.generation:
+            with self.range_locked(0, HEADER_SIZE):
+                self.refresh()
+        return self.index.get(order_id)
+
+    def read(self, slot, attempts=100):
+        """Decode a slot's record, retrying while another process is halfway through rewriting it."""
+        offset = self.offset(slot)
+        for _ in range(attempts):
+            _, key_length, record_length, crc = SLOT_HEADER.unpack_from(self.mm, offset)
+            start = offset + SLOT_HEADER.size
+            body = self.mm[start:start + key_length + record_length]
+            if zlib.crc32(body) == crc:
+                return order_record.decode(body[key_length:])
+        raise ValueError(f"Slot {slot} of {self.filename} keeps failing its checksum")
+
+    def load(self, order_id=DEFAULT_ORDER):
+        slot = self.slot_of(order_id)
+        return None if slot is None else self.read(slot)
+
+    def load_all(self):
+        with self.header_locked():
+            return {order_id: self.read(slot) for order_id, slot in self.index.items()}
+
+    def load_unfinished(self, max_steps):
+        with self.header_locked():
+            records = ((order_id, self.read(slot)) for order_id, slot in self.index.items())
+            return {order_id: record for order_id, record in records if record.step <= max_steps}
+
+    def write(self, slot, key, data):
+        offset = self.offset(slot)
+        slot_data = SLOT_HEADER.pack(USED, len(key), len(data), zlib.crc32(key + data)) + key + data
+        self.mm[offset:offset + len(slot_data)] = slot_data
+        self.bytes_written += len(slot_data)
+
+    def encode(self, state, order_id):
+        key, data = order_id.encode(), order_record.encode(detach(state))
+        if SLOT_HEADER.size + len(key) + len(data) > self.slot_size:
+            raise ValueError(f"Order {order_id} needs {SLOT_HEADER.size + len(key) + len(data)} bytes; "
+                             f"slots in {self.filename} hold {self.slot_size}")
+        return key, data
+
+    def save(self, state, order_id=DEFAULT_ORDER):
+        key, data = self.encode(state, order_id)
+        slot = self.slot_of(order_id)
+        if slot is not None:
+            self.write(slot, key, data)
+        else:
+            with self.header_locked():
+                slot = self.index.get(order_id)  # Another process may have added it meanwhile
+                if slot is None:
+                    slot = self.index[order_id] = self.allocate()
+                    self.changed(slot, USED)
+                self.write(slot, key, data)
+        self.written()
+
+    def setdefault(self, order_id, state):
+        """Save state unless order_id is already saved, deciding under the header lock so two processes can't both add it."""
+        if self.slot_of(order_id) is None:
+            key, data = self.encode(state, order_id)
+            with self.header_locked():
+                if order_id not in self.index:
+                    slot = self.index[order_id] = self.allocate()
+                    self.changed(slot, USED)
+                    self.write(slot, key, data)
+                    self.written()
+        return self.load(order_id)
+
+    def delete(self, order_id):
+        with self.header_locked():
+            slot = self.index.pop(order_id, None)
+            if slot is None:
+                return
+            self.mm[self.offset(slot)] = FREE
+            self.free.append(slot)
+            self.changed(slot, FREE)
+        self.bytes_written += 1
+        self.written()
+
+    def written(self):
+        self.unflushed += 1
+        if self.group_size and self.unflushed >= self.group_size:
+            self.commit()
+
+    def commit(self):
+        if self.unflushed:
+            self.mm.flush()
+            self.unflushed = 0
+
+    def close(self):
+        self.commit()
+        for mm in self.superseded + [self.mm]:
+            mm.close()
+        self.file.close()
@@ -0,0 +1,178 @@
+import pickle
+import struct
+import time
+
+RECORD_VERSION = 1
+# version, flags, step, retry_count, created, updated (whole seconds); then the two masks as varints
+RECORD = struct.Struct("<BBHHII")
+HAS_EXTRA = 0x01
+NEEDS_REVALIDATION = 0x02
+PARKED = 0x04
+
+def write_varint(n):
+    """LEB128: 7 bits per byte, so masks of short pipelines take a byte however long they grow."""
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def read_varint(data, offset):
+    """Return (value, offset just past it)."""
+    n = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, offset
+        shift += 7
+
+class OrderRecord:
+    """Fixed-layout state of one order.
+
+    The fields every runner uses are slots, and the record behaves like the
+    state dicts the runners were written against: record["step"] += 1,
+    record.get("needs_revalidation") and record.setdefault("fingerprints", {})
+    all work. Keys that aren't fields (e.g. Revalidation's fingerprints) are
+    kept in a small extra dict, which is only allocated when used.
+
+    encode() packs a record into 16 bytes for pipelines of up to 7 steps
+    (timestamps to the second), plus a pickle of any extra fields; decode()
+    reads any version it knows. Old state dicts, including the
+    step_N_completed flags and completed_steps lists, are converted by
+    from_dict().
+    """
+
+    __slots__ = ("step", "retry_count", "completed_mask", "skipped_mask", "needs_revalidation", "parked",
+                 "created", "updated", "extra")
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, step=1, retry_count=0, completed_mask=0, skipped_mask=0, needs_revalidation=False,
+                 parked=False, created=None, updated=None, extra=None):
+        self.step = step
+        self.retry_count = retry_count
+        self.completed_mask = completed_mask
+        self.skipped_mask = skipped_mask
+        self.needs_revalidation = needs_revalidation
+        self.parked = parked  # Parked for an operator, with the retry_count it failed at
+        self.created = time.time() if created is None else created
+        self.updated = self.created if updated is None else updated
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, state):
+        """Build a record from a state dict as saved by the runners before records existed."""
+        record = cls()
+        for key, value in state.items():
+            if key.startswith("step_") and key.endswith("_completed"):
+                if value:
+                    record.completed_mask |= 1 << (int(key.split("_")[1]) - 1)
+            elif key.startswith("step_") and key.endswith("_skipped"):
+                if value:
+                    record.skipped_mask |= 1 << (int(key.split("_")[1]) - 1)
+            elif key == "completed_steps":
+                for step in value:
+                    record.completed_mask |= 1 << (step - 1)
+            else:
+                record[key] = value
+        return record
+
+    @classmethod
+    def coerce(cls, state):
+        """Return state as a record, converting a dict if needed."""
+        return state if isinstance(state, cls) else cls.from_dict(state)
+
+    # Mapping-style access, so runner code written against dicts keeps working
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS or not self.extra or key not in self.extra:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __contains__(self, key):
+        return key in self.FIELDS or bool(self.extra) and key in self.extra
+
+    def __iter__(self):
+        yield from self.FIELDS
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return len(self.FIELDS) + len(self.extra or ())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in (self.extra or ()):
+            return self.extra.pop(key)
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (OrderRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"OrderRecord({self.to_dict()!r})"
+
+    def __deepcopy__(self, memo):
+        return decode(encode(self))
+
+def encode(record):
+    """Pack a record (or a state dict) into bytes."""
+    record = OrderRecord.coerce(record)
+    flags = ((HAS_EXTRA if record.extra else 0) | (NEEDS_REVALIDATION if record.needs_revalidation else 0)
+             | (PARKED if record.parked else 0))
+    data = (RECORD.pack(RECORD_VERSION, flags, record.step, record.retry_count, int(record.created), int(record.updated))
+            + write_varint(record.completed_mask) + write_varint(record.skipped_mask))
+    if record.extra:
+        data += pickle.dumps(record.extra)
+    return data
+
+def decode(data):
+    """Unpack bytes written by encode()."""
+    if data[0] != RECORD_VERSION:
+        raise ValueError(f"Unknown order record version {data[0]}")
+    _, flags, step, retry_count, created, updated = RECORD.unpack_from(data)
+    completed_mask, offset = read_varint(data, RECORD.size)
+    skipped_mask, offset = read_varint(data, offset)
+    extra = pickle.loads(data[offset:]) if flags & HAS_EXTRA else None
+    return OrderRecord(step, retry_count, completed_mask, skipped_mask, bool(flags & NEEDS_REVALIDATION),
+                       bool(flags & PARKED), created, updated, extra)
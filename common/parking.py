@@ -0,0 +1,139 @@
+import json
+import os
+import sys
+import time
+import file_lock
+
+class ParkingLot:
+    """Durable list of orders parked after a failure, waiting for an operator.
+
+    Parking appends a "park" event to a JSON-lines file, so runners never
+    block on input(). The current set of parked orders is built from the
+    events and kept up to date by reading only the lines appended since the
+    last look. Releasing rewrites the file with just the orders still
+    parked, so it never grows past the parked set.
+    """
+
+    def __init__(self, filename="parked_orders.jsonl"):
+        self.filename = filename
+        self.inode = None
+        self.offset = 0  # Bytes of the file already applied to entries
+        self.entries = {}
+
+    def apply(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return  # Partial line from a crash mid-append
+        if event["event"] == "park":
+            self.entries[event["order_id"]] = event
+        else:
+            self.entries.pop(event["order_id"], None)
+
+    def refresh(self):
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            self.inode, self.offset, self.entries = None, 0, {}
+            return
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.inode, self.offset, self.entries = st.st_ino, 0, {}  # Compacted or replaced: read it afresh
+        if st.st_size == self.offset:
+            return
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # A line still being appended is applied next time
+        for line in data[:end].splitlines():
+            self.apply(line)
+        self.offset += end
+
+    def locked(self):
+        """Open and lock the lock file beside the parked orders file; closing it unlocks."""
+        lock = open(self.filename + ".lock", "a")
+        file_lock.lock_file(lock)
+        return lock
+
+    def append(self, event):
+        with self.locked(), open(self.filename, "a+b") as f:
+            line = json.dumps(event).encode() + b"\n"
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line  # Don't glue the event onto a line cut short by a crash
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def parked(self):
+        """Return {order_id: park event} for every order still parked."""
+        self.refresh()
+        return dict(self.entries)
+
+    def is_parked(self, order_id):
+        self.refresh()
+        return order_id in self.entries
+
+    def park(self, order_id, step, error, state=None):
+        """Park an order. Its state, if given, is flagged parked and keeps the retry_count it failed at."""
+        self.append({"event": "park", "order_id": order_id, "step": step,
+                     "error": f"{type(error).__name__}: {error}", "time": time.time()})
+        if state is not None:
+            state["parked"] = True
+
+    @staticmethod
+    def resume(state):
+        """Clear the parked flag of an order that was released, giving it fresh retries. Returns True if it was set."""
+        if not state.get("parked"):
+            return False
+        state["parked"] = False
+        state["retry_count"] = 0
+        return True
+
+    def release(self, *order_ids):
+        """Release parked orders, compacting the file to the ones still parked. Returns those that were parked."""
+        with self.locked():
+            self.refresh()
+            released = [order_id for order_id in order_ids if order_id in self.entries]
+            if not released:
+                return released
+            for order_id in released:
+                del self.entries[order_id]
+            temp = self.filename + ".tmp"
+            with open(temp, "w") as f:
+                for event in self.entries.values():
+                    f.write(json.dumps(event) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.filename)  # Other readers see a new inode and read it afresh
+            st = os.stat(self.filename)
+            self.inode, self.offset = st.st_ino, st.st_size
+        return released
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="List or release parked orders.")
+    parser.add_argument("command", choices=["list", "release"])
+    parser.add_argument("order_ids", nargs="*", help="orders to release")
+    parser.add_argument("--all", action="store_true", help="release every parked order")
+    parser.add_argument("--file", default="parked_orders.jsonl", help="parked orders file")
+    args = parser.parse_args()
+
+    lot = ParkingLot(args.file)
+    if args.command == "list":
+        parked = lot.parked()
+        for order_id, entry in parked.items():
+            parked_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"]))
+            print(f"{order_id}: Step {entry['step']} at {parked_at} - {entry['error']}")
+        print(f"{len(parked)} parked orders")
+    else:
+        order_ids = list(lot.parked()) if args.all else args.order_ids
+        if not order_ids:
+            sys.exit("Nothing to release; pass order IDs or --all.")
+        released = lot.release(*order_ids)
+        for order_id in order_ids:
+            if order_id in released:
+                print(f"Released {order_id}.")
+            else:
+                print(f"{order_id} is not parked.")
@@ -0,0 +1,241 @@
+import math
+import random
+import time
+import metrics
+
+class RetryPolicy:
+    """How often and how long to wait before retrying a failed step.
+
+    Delays grow exponentially from base_delay and are capped at max_delay.
+    With jitter (the default) the actual delay is drawn uniformly from
+    [0, capped delay] ("full jitter"), so orders that failed together do not
+    retry together.
+    """
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=30.0, jitter=True):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number `attempt` (1-based)."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if self.jitter:
+            return random.uniform(0, delay)
+        return delay
+
+class TokenBucket:
+    """Token bucket holding up to `capacity` tokens, refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available. Returns False instead of waiting."""
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens=1):
+        """Seconds until tokens will be available, 0 if they are now."""
+        self.refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+class RateLimit:
+    """Limits on a step's calls to the service behind it.
+
+    At most `concurrency` calls in flight at once, and at most `rate` calls
+    per second on average, with bursts of up to `burst` calls (default: one
+    second's worth). Either may be None for no limit.
+    """
+
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or (max(1.0, rate) if rate else None)
+
+class StepLimiter:
+    """Enforce each step's RateLimit on behalf of a scheduler.
+
+    try_acquire(step) admits a call, taking a concurrency slot and a token,
+    and returns 0; or it admits nothing and returns how many seconds to wait
+    before asking again, so the scheduler can run other work meanwhile
+    instead of calling into a throttled service and feeding the retry loop.
+    release(step) returns the slot once the call is over. Steps without a
+    limit are always admitted. Like the TokenBucket, it is not thread-safe:
+    the scheduler calls it from its own thread.
+
+    Metrics per step: step_in_flight and step_queue_depth gauges (calls
+    admitted and running, and calls held back; schedulers set the latter)
+    and a step_throttled_total counter of refused admissions.
+    """
+
+    def __init__(self, limits, slot_wait=0.01):
+        self.limits = limits  # step -> RateLimit
+        self.slot_wait = slot_wait  # Poll interval while every slot is taken
+        self.buckets = {step: TokenBucket(limit.rate, limit.burst) for step, limit in limits.items() if limit.rate}
+        self.in_flight = {step: 0 for step in limits}
+
+    def interval(self, step):
+        """Seconds between calls to step at its rate limit; 0 if it has none."""
+        bucket = self.buckets.get(step)
+        return 1.0 / bucket.rate if bucket else 0.0
+
+    def try_acquire(self, step):
+        """Admit one call to step. Returns 0, or the seconds to wait before trying again."""
+        limit = self.limits.get(step)
+        if limit is None:
+            return 0.0
+        if limit.concurrency and self.in_flight[step] >= limit.concurrency:
+            delay = self.slot_wait
+        else:
+            bucket = self.buckets.get(step)
+            delay = 0.0 if bucket is None or bucket.try_acquire() else bucket.wait_time()
+        if delay:
+            metrics.registry.counter("step_throttled_total", step=step).inc()
+            return delay
+        self.in_flight[step] += 1
+        metrics.registry.gauge("step_in_flight", step=step).set(self.in_flight[step])
+        return 0.0
+
+    def release(self, step):
+        if step in self.in_flight:
+            self.in_flight[step] -= 1
+            metrics.registry.gauge("step_in_flight", step=step).set(self.in_flight[step])
+
+    def queued(self, step, depth):
+        """Report how many calls to step the scheduler is holding back."""
+        metrics.registry.gauge("step_queue_depth", step=step).set(depth)
+
+class CircuitBreaker:
+    """Stop calling a step after repeated failures, then probe it again.
+
+    After failure_threshold consecutive failures the breaker opens and
+    allow() refuses calls for reset_timeout seconds. It then lets a single
+    probe through (half-open): a success closes it, a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.probing or self.remaining() > 0:
+            return False
+        self.probing = True  # Half-open: let one call through
+        return True
+
+    def remaining(self):
+        """Seconds until an open breaker lets a probe through."""
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+class RetryPolicies:
+    """Per-step retry policies, one circuit breaker per step and a shared retry budget.
+
+    The budget is a token bucket spent by every retry across all orders; when
+    it runs dry, runners back off until it refills (plus jitter, up to the
+    policy's max_delay) instead of piling more retries onto a struggling
+    service.
+    """
+
+    def __init__(self, default=None, per_step=None, budget=None, breaker_threshold=20, breaker_reset=5.0):
+        self.default = default or RetryPolicy()
+        self.per_step = per_step or {}
+        self.budget = budget or TokenBucket(rate=50.0, capacity=500)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.breakers = {}
+
+    def policy_for(self, step):
+        return self.per_step.get(step, self.default)
+
+    def breaker_for(self, step):
+        breaker = self.breakers.get(step)
+        if breaker is None:
+            breaker = self.breakers[step] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return breaker
+
+    def retry_delay(self, step, attempt):
+        """Delay before retry `attempt` of step; longer, up to the policy's max_delay, if the budget is spent."""
+        policy = self.policy_for(step)
+        if self.budget.try_acquire():
+            return policy.delay(attempt)
+        # Jittered too, so the orders held back by an empty budget don't all come back at once
+        return min(policy.max_delay, self.budget.wait_time() + policy.delay(attempt))
+
+class TimerWheel:
+    """Hashed timer wheel for scheduling retries without sleeping.
+
+    schedule() is O(1); advance() walks the slots for the ticks that have
+    elapsed and returns the items that fell due. Delays are rounded up to a
+    whole number of ticks.
+    """
+
+    def __init__(self, tick=0.05, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.last_tick = time.monotonic()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, item, now=None):
+        now = time.monotonic() if now is None else now
+        if not self.count:
+            self.last_tick = now  # Nothing pending, so the wheel can skip the idle time
+        lag = int((now - self.last_tick) / self.tick)  # Ticks that advance() has not walked yet
+        ticks = lag + max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            offset, rounds = len(self.slots), rounds - 1
+        self.slots[(self.current + offset) % len(self.slots)].append([rounds, item])
+        self.count += 1
+
+    def advance(self, now=None):
+        """Return the items whose delay has elapsed by `now`."""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self.count and self.last_tick + self.tick <= now:
+            self.last_tick += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            waiting = []
+            for entry in self.slots[self.current]:
+                if entry[0] == 0:
+                    expired.append(entry[1])
+                    self.count -= 1
+                else:
+                    entry[0] -= 1
+                    waiting.append(entry)
+            self.slots[self.current] = waiting
+        return expired
@@ -0,0 +1,153 @@
+import pickle
+import sqlite3
+import order_record
+from order_record import OrderRecord
+from state_store import StateStore, DEFAULT_ORDER, detach
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    step INTEGER NOT NULL,
+    retry_count INTEGER NOT NULL,
+    completed_mask INTEGER NOT NULL,
+    done INTEGER NOT NULL,
+    needs_revalidation INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    state BLOB NOT NULL,
+    parked INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS orders_step_retry ON orders (step, retry_count);
+CREATE INDEX IF NOT EXISTS orders_retry ON orders (retry_count);
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS orders_flags ON orders (done, needs_revalidation, completed_mask);
+CREATE INDEX IF NOT EXISTS orders_parked ON orders (parked, step);
+"""
+COLUMNS = "order_id, step, retry_count, completed_mask, done, needs_revalidation, updated_at, state, parked"
+
+def completed_mask(state, max_steps):
+    """Bitmask of completed steps (bit N-1 for step N) from any runner's state layout."""
+    mask = state.get("completed_mask", 0)
+    for step in range(1, max_steps + 1):
+        if state.get(f"step_{step}_completed"):
+            mask |= 1 << (step - 1)
+    for step in state.get("completed_steps", ()):
+        mask |= 1 << (step - 1)
+    if not mask:
+        mask = (1 << (min(state.get("step", 1), max_steps + 1) - 1)) - 1  # Linear runners
+    return mask
+
+class SQLiteStateStore(StateStore):
+    """State store in a SQLite database, one row per order.
+
+    Besides the encoded state, each row keeps the step, retry count,
+    completion bitmask and flags in indexed columns so orders can be queried
+    without decoding them. A parked order keeps the retry_count it failed
+    at. done needs the pipeline's length: pass max_steps to save orders. The database runs in WAL mode; saves are
+    grouped into one transaction that is committed on commit() or once
+    group_size saves are pending.
+
+    Other processes can read the database while a runner writes it, but
+    writers queue on SQLite's database lock for a whole group and orders
+    can't be claimed; runners that share a store use .mmap.
+    """
+
+    def __init__(self, filename, group_size=500, max_steps=None):
+        self.filename = filename
+        self.group_size = group_size
+        self.max_steps = max_steps
+        self.pending = 0
+        self.db = sqlite3.connect(filename, check_same_thread=False)  # Callers serialize use, e.g. a checkpoint flusher thread
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(orders)")]
+        if "parked" not in columns:  # Databases created before the column
+            self.db.execute("ALTER TABLE orders ADD COLUMN parked INTEGER NOT NULL DEFAULT 0")
+        self.db.executescript(INDEXES)
+
+    @staticmethod
+    def decode(blob):
+        if blob[:1] == pickle.PROTO:  # Rows saved before order records
+            return OrderRecord.coerce(pickle.loads(blob))
+        return order_record.decode(blob)
+
+    def load(self, order_id=DEFAULT_ORDER):
+        row = self.db.execute("SELECT state FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return self.decode(row[0]) if row else None
+
+    def load_all(self):
+        return {order_id: self.decode(state) for order_id, state in self.db.execute("SELECT order_id, state FROM orders")}
+
+    def load_unfinished(self, max_steps):
+        """Return {order_id: state} for unfinished orders, found through the step index without reading the rest."""
+        return {order_id: self.decode(state) for order_id, state in
+                self.db.execute("SELECT order_id, state FROM orders WHERE step <= ?", (max_steps,))}
+
+    def save(self, state, order_id=DEFAULT_ORDER):
+        if self.max_steps is None:
+            raise ValueError(f"{self.filename}: open the store with max_steps to save orders")
+        record = detach(state)
+        self.db.execute(
+            f"INSERT OR REPLACE INTO orders ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (order_id, record.step, record.retry_count, completed_mask(record, self.max_steps),
+             int(record.step > self.max_steps), int(record.needs_revalidation), record.updated,
+             order_record.encode(record), int(record.parked)),
+        )
+        self.written()
+
+    def delete(self, order_id):
+        self.db.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+        self.written()
+
+    def written(self):
+        self.pending += 1
+        if self.pending >= self.group_size:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def query(self, step=None, min_retries=None, done=None, needs_revalidation=None, completed=None, limit=None,
+              parked=None):
+        """Return (order_id, step, retry_count, completed_mask, done, needs_revalidation, parked, updated_at) rows.
+
+        completed is a step number that must be among the completed steps.
+        """
+        where, params = [], []
+        if step is not None:
+            where.append("step = ?")
+            params.append(step)
+        if min_retries is not None:
+            where.append("retry_count >= ?")
+            params.append(min_retries)
+        if done is not None:
+            where.append("done = ?")
+            params.append(int(done))
+        if needs_revalidation is not None:
+            where.append("needs_revalidation = ?")
+            params.append(int(needs_revalidation))
+        if completed is not None:
+            where.append("completed_mask & ? != 0")
+            params.append(1 << (completed - 1))
+        if parked is not None:
+            where.append("parked = ?")
+            params.append(int(parked))
+
+        sql = "SELECT order_id, step, retry_count, completed_mask, done, needs_revalidation, parked, updated_at FROM orders"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY order_id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.db.execute(sql, params).fetchall()
+
+    def count_by_step(self):
+        """Return {step: number of orders} for unfinished orders."""
+        return dict(self.db.execute("SELECT step, COUNT(*) FROM orders WHERE done = 0 GROUP BY step"))
@@ -0,0 +1,337 @@
+import copy
+import os
+import pickle
+import struct
+import time
+import zlib
+import file_lock
+import order_record
+from order_record import OrderRecord, read_varint, write_varint
+
+DEFAULT_ORDER = "default"  # Key used by the single-order runners
+SNAPSHOT_FORMAT = "state-store-snapshot-v1"  # Pickled snapshots, still readable
+SNAPSHOT_MAGIC = b"ORDSNAP2"  # Then per order: varint order_id length, order_id, varint record length, record
+RECORD_HEADER = struct.Struct("<II")  # payload length, crc32 of payload
+JOURNAL_ENTRY = struct.Struct("<cH")  # op (b"P"ut or b"D"elete), order_id length
+
+class StoreLocked(Exception):
+    """The store's file is in use by another process."""
+
+def lock_exclusively(filename):
+    """Take an exclusive lock on filename's .lock file for this process, or raise StoreLocked."""
+    lock_file = open(f"{filename}.lock", "a")
+    if not file_lock.lock_file(lock_file, blocking=False):
+        lock_file.close()
+        raise StoreLocked(f"{filename} is in use by another process; stores that several runners share "
+                          f"must be memory-mapped (.mmap)")
+    return lock_file
+
+def write_atomic(filename, data, fsync=True):
+    """Write bytes to a temporary file and rename it over filename."""
+    tmp = f"{filename}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, filename)
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def detach(state):
+    """Return a stamped copy of state as an OrderRecord, sharing nothing with the caller's object."""
+    record = order_record.decode(order_record.encode(state))
+    record.updated = time.time()
+    return record
+
+def read_snapshot(filename):
+    """Load a snapshot file into an {order_id: OrderRecord} dict.
+
+    Besides the binary format written by write_snapshot, this reads the
+    pickled snapshots written before it, and a plain pickled state dict
+    written by the old save_state, which becomes the state of DEFAULT_ORDER.
+    """
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    if data.startswith(SNAPSHOT_MAGIC):
+        orders = {}
+        offset = len(SNAPSHOT_MAGIC)
+        while offset < len(data):
+            key_length, offset = read_varint(data, offset)
+            order_id = data[offset:offset + key_length].decode()
+            record_length, offset = read_varint(data, offset + key_length)
+            orders[order_id] = order_record.decode(data[offset:offset + record_length])
+            offset += record_length
+        return orders
+
+    data = pickle.loads(data)
+    if isinstance(data, dict) and data.get("__format__") == SNAPSHOT_FORMAT:
+        return {order_id: OrderRecord.coerce(state) for order_id, state in data["orders"].items()}
+    return {DEFAULT_ORDER: OrderRecord.coerce(data)}
+
+def write_snapshot(filename, orders, fsync=True):
+    """Write an {order_id: state} snapshot. Returns the number of bytes written."""
+    parts = [SNAPSHOT_MAGIC]
+    for order_id, state in orders.items():
+        key, record = order_id.encode(), order_record.encode(state)
+        parts += [write_varint(len(key)), key, write_varint(len(record)), record]
+    data = b"".join(parts)
+    write_atomic(filename, data, fsync)
+    return len(data)
+
+class StateStore:
+    """Persistent {order_id: state} mapping shared by the runners.
+
+    save() accepts a state dict or an OrderRecord; the load methods return
+    OrderRecords. The default load methods read self.orders; backends that don't keep
+    every order in memory override them, and runners that stream orders
+    through (ingest, daemon) need one of those: SQLite or mmap. bytes_written counts what the
+    store has written to disk since it was opened.
+
+    Stores with shared = True can be used by several processes at once;
+    lock() claims an order so that only one of them runs it. The others
+    belong to one process, and the lock methods do nothing.
+    """
+
+    bytes_written = 0
+    shared = False
+
+    def load(self, order_id=DEFAULT_ORDER):
+        return copy.deepcopy(self.orders.get(order_id))
+
+    def load_all(self):
+        return copy.deepcopy(self.orders)
+
+    def load_unfinished(self, max_steps):
+        """Return {order_id: state} for the orders not yet past step max_steps, parked ones included."""
+        return {order_id: copy.deepcopy(state) for order_id, state in self.orders.items() if state.step <= max_steps}
+
+    def save(self, state, order_id=DEFAULT_ORDER):
+        raise NotImplementedError
+
+    def delete(self, order_id):
+        raise NotImplementedError
+
+    def setdefault(self, order_id, state):
+        """Save state unless order_id is already saved. Returns the saved state."""
+        saved = self.load(order_id)
+        if saved is None:
+            self.save(state, order_id)
+            saved = self.load(order_id)
+        return saved
+
+    def lock(self, order_id, blocking=True):
+        """Claim order_id against other processes. Returns False if another process holds it and blocking=False."""
+        return True
+
+    def unlock(self, order_id):
+        pass
+
+    def commit(self):
+        """Make every save so far durable."""
+
+    def close(self):
+        self.commit()
+
+class PickleStateStore(StateStore):
+    """The original whole-file store: a snapshot rewritten atomically on every save.
+
+    The file belongs to one process; opening it from a second raises StoreLocked.
+    """
+
+    def __init__(self, filename, fsync=False):
+        self.filename = filename
+        self.fsync = fsync
+        self.lock_file = lock_exclusively(filename)
+        self.orders = read_snapshot(filename)
+
+    def save(self, state, order_id=DEFAULT_ORDER):
+        self.orders[order_id] = detach(state)
+        self.bytes_written += write_snapshot(self.filename, self.orders, self.fsync)
+
+    def delete(self, order_id):
+        self.orders.pop(order_id, None)
+        self.bytes_written += write_snapshot(self.filename, self.orders, self.fsync)
+
+    def close(self):
+        self.lock_file.close()
+
+class JournalStateStore(StateStore):
+    """Snapshot file plus an append-only journal of per-order updates.
+
+    Each save appends one length-prefixed, checksummed record holding only
+    that order's state. Records are buffered and written together on
+    commit(), or once group_size of them are pending. With fsync=True every
+    fsync_every-th write is followed by an fsync. After compact_every records
+    the journal is folded into a new snapshot (written to a temporary file and
+    renamed) and truncated. On open, a torn or corrupt tail left by a crash is
+    discarded and the journal is truncated back to the last good record.
+
+    The files belong to one process: a second process replaying the journal
+    would truncate records the first is still appending, so opening the
+    store while another process has it open raises StoreLocked.
+    """
+
+    def __init__(self, filename, group_size=1, fsync=False, fsync_every=1, compact_every=1000):
+        self.filename = filename
+        self.journal_file = f"{filename}.journal"
+        self.group_size = group_size
+        self.fsync = fsync
+        self.fsync_every = fsync_every
+        self.compact_every = compact_every
+        self.buffer = []
+        self.writes_since_fsync = 0
+        self.lock_file = lock_exclusively(filename)
+        self.orders = read_snapshot(filename)
+        self.records = self.recover()
+        self.journal = open(self.journal_file, "ab")
+
+    def recover(self):
+        """Replay the journal over the snapshot. Returns the number of records replayed."""
+        try:
+            with open(self.journal_file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+
+        offset = 0
+        records = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break  # Torn write from a crash; everything after it is unusable
+            self.apply(*self.decode(payload))
+            offset = start + length
+            records += 1
+
+        if offset < len(data):
+            print(f"Discarding {len(data) - offset} bytes of incomplete journal in {self.journal_file}.")
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(offset)
+        return records
+
+    @staticmethod
+    def encode(op, order_id, record):
+        key = order_id.encode()
+        data = order_record.encode(record) if op == "put" else b""
+        return JOURNAL_ENTRY.pack(op[0].upper().encode(), len(key)) + key + data
+
+    @staticmethod
+    def decode(payload):
+        """Return (op, order_id, state) from a journal record, binary or (older journals) pickled."""
+        if payload[:1] == pickle.PROTO:
+            op, order_id, state = pickle.loads(payload)
+            return op, order_id, OrderRecord.coerce(state) if state is not None else None
+        code, key_length = JOURNAL_ENTRY.unpack_from(payload)
+        start = JOURNAL_ENTRY.size + key_length
+        order_id = payload[JOURNAL_ENTRY.size:start].decode()
+        if code == b"D":
+            return "del", order_id, None
+        return "put", order_id, order_record.decode(payload[start:])
+
+    def apply(self, op, order_id, state):
+        if op == "put":
+            self.orders[order_id] = state
+        else:
+            self.orders.pop(order_id, None)
+
+    def append(self, op, order_id, state):
+        record = detach(state) if op == "put" else None  # Keep a detached copy in memory
+        payload = self.encode(op, order_id, record)
+        self.buffer.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.apply(op, order_id, record)
+        if len(self.buffer) >= self.group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = b"".join(self.buffer)
+        self.journal.write(data)
+        self.journal.flush()
+        self.bytes_written += len(data)
+        self.records += len(self.buffer)
+        self.buffer = []
+        self.writes_since_fsync += 1
+        if self.fsync and self.writes_since_fsync >= self.fsync_every:
+            os.fsync(self.journal.fileno())
+            self.writes_since_fsync = 0
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot and start an empty journal."""
+        self.flush()
+        self.bytes_written += write_snapshot(self.filename, self.orders, self.fsync)
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        self.records = 0
+
+    def save(self, state, order_id=DEFAULT_ORDER):
+        self.append("put", order_id, state)
+
+    def delete(self, order_id):
+        self.append("del", order_id, None)
+
+    def commit(self):
+        self.flush()
+        if self.fsync and self.writes_since_fsync:
+            os.fsync(self.journal.fileno())  # Don't leave batched writes unsynced past a commit
+            self.writes_since_fsync = 0
+
+    def close(self):
+        self.commit()
+        self.journal.close()
+        self.lock_file.close()
+
+BACKENDS = {
+    "pickle": PickleStateStore,
+    "journal": JournalStateStore,
+}
+
+STREAMING_BACKENDS = ("sqlite", "mmap")  # Keep orders on disk, not all in memory
+
+def backend_for(filename):
+    """Pick a backend from the file extension: .db/.sqlite is SQLite, .mmap memory-mapped, anything else the journal."""
+    if filename.endswith((".db", ".sqlite")):
+        return "sqlite"
+    if filename.endswith(".mmap"):
+        return "mmap"
+    return "journal"
+
+_open_stores = {}
+
+def open_store(filename, backend=None, max_steps=None, **options):
+    """Return the store for filename, opening it on first use.
+
+    max_steps is the length of the caller's pipeline; SQLite stores need it
+    to fill in their done column.
+    """
+    store = _open_stores.get(filename)
+    if store is None:
+        backend = backend or backend_for(filename)
+        if backend == "sqlite":
+            from sqlite_store import SQLiteStateStore  # Only needed by SQLite users
+            store = SQLiteStateStore(filename, max_steps=max_steps, **options)
+        elif backend == "mmap":
+            from mmap_store import MmapStateStore  # Only needed by mmap users
+            store = MmapStateStore(filename, **options)
+        else:
+            store = BACKENDS[backend](filename, **options)
+        _open_stores[filename] = store
+    return store
+
+def close_stores():
+    """Close every store opened through open_store()."""
+    for store in _open_stores.values():
+        store.close()
+    _open_stores.clear()
@@ -0,0 +1,106 @@
+import atexit
+import dbm
+import hashlib
+import os
+import pickle
+import shelve
+import time
+from collections import OrderedDict
+import metrics
+
+MISS = object()
+DISK_ERRORS = dbm.error + (OSError, pickle.PickleError)  # dbm.error is a tuple covering every dbm backend
+log = metrics.get_logger("step_cache")
+
+def input_hash(*parts):
+    """Short stable hash of the repr of a step's inputs."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+class StepCache:
+    """Results of idempotent steps, keyed by (order id, step, input hash, logic version).
+
+    An in-memory LRU of up to max_entries results sits in front of an
+    optional shelve file, so results survive across runs. Entries expire
+    ttl seconds after they were stored, in either tier. The shelve is only
+    opened on first use, at the path the filename named when the cache was
+    made, and errors from it are logged and treated as a miss; the cache
+    never fails the step it serves.
+
+    Only cache steps whose result depends on nothing but the inputs that
+    went into the key; a changed input hash or logic version is a miss.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600.0, filename=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.filename = os.path.abspath(filename) if filename else None  # Not wherever the cwd is on first use
+        self.entries = OrderedDict()  # key -> (expires, result), least recently used first
+        self.disk = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(order_id, step, inputs, logic_version):
+        return f"{order_id}|{step}|{inputs}|{logic_version}"  # shelve keys must be strings
+
+    def shelf(self):
+        if self.disk is None and self.filename:
+            self.disk = shelve.open(self.filename)
+            atexit.register(self.close)
+        return self.disk
+
+    def disk_error(self, action, error):
+        metrics.registry.counter("step_cache_errors_total").inc()
+        log.warning(f"Step cache {self.filename}: {action} failed ({type(error).__name__}: {error}); carrying on without it.")
+
+    def get(self, key):
+        """Return the cached result, or MISS."""
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None:
+            try:
+                if self.shelf() is not None:
+                    entry = self.disk.get(key)
+            except DISK_ERRORS as e:
+                self.disk_error("read", e)
+            if entry is not None:
+                self.remember(key, entry)  # Promote to the memory tier
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                self.forget(key)
+            self.misses += 1
+            return MISS
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, result):
+        entry = (time.time() + self.ttl, result)
+        self.remember(key, entry)
+        try:
+            if self.shelf() is not None:
+                self.disk[key] = entry
+        except DISK_ERRORS as e:
+            self.disk_error("write", e)
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def forget(self, key):
+        self.entries.pop(key, None)
+        try:
+            if self.shelf() is not None and key in self.disk:
+                del self.disk[key]
+        except DISK_ERRORS as e:
+            self.disk_error("delete", e)
+
+    def close(self):
+        if self.disk is not None:
+            disk, self.disk = self.disk, None
+            try:
+                disk.close()
+            except DISK_ERRORS as e:
+                self.disk_error("close", e)
@@ -0,0 +1,260 @@
+class Step:
+    """A registered step: its handler plus what the runners need to know about it."""
+
+    def __init__(self, number, name, handler, depends_on=(), retry_policy=None, timeout=None,
+                 on_exhausted="park", revalidate=True, rate_limit=None):
+        self.number = number
+        self.name = name
+        self.handler = handler
+        self.depends_on = tuple(depends_on)  # Step numbers or names until compile()
+        self.retry_policy = retry_policy
+        self.timeout = timeout  # Seconds, or None for the runner's default
+        self.on_exhausted = on_exhausted  # "park" the order or "skip" the step once retries run out
+        self.revalidate = revalidate  # False: stays completed when a step upstream is invalidated
+        self.rate_limit = rate_limit  # RateLimit on calls to the service behind the step, or None
+
+class StepRegistry:
+    """Steps of a pipeline, registered with a decorator and compiled once at import.
+
+        registry = StepRegistry()
+
+        @registry.step(1, "verify_payment", timeout=10, rate_limit=RateLimit(concurrency=8, rate=50))
+        def verify_payment():
+            ...
+
+        @registry.step(2, "prepare_shipment", depends_on=["verify_payment"])
+        def prepare_shipment():
+            ...
+
+        registry.compile()
+        process_step = registry.process_step
+
+    compile() checks that steps are numbered 1..n, that every dependency
+    exists and that the graph has no cycles, then builds a dispatch table
+    indexed by step number, so process_step() is a list lookup however many
+    steps there are.
+
+    A step may also have a batch handler, registered with @registry.batch(n),
+    which takes a list of order IDs and returns one result per order: True
+    or False, or an exception instance for an order that failed. Raising
+    fails the whole batch. Runners that hold many orders at the same step
+    call process_step_batch() for batchable() steps instead of process_step()
+    once per order.
+
+    It also precomputes, as bitmasks (bit N-1 for step N, the same layout as
+    an order's completed_mask), every step's transitive dependencies and
+    transitive dependents. retry_set(), invalidate() and ready() are then a
+    couple of integer operations per step. graph() returns all of this as plain data
+    and install() restores it without compiling, for compiled pipeline plans
+    cached on disk (see pipeline.py).
+    """
+
+    def __init__(self):
+        self.steps = {}  # number -> Step
+        self.batch_handlers = {}  # number -> handler(order_ids)
+        self.dispatch = None
+        self.dependencies = None
+        self.order = None
+        self.ancestors = None  # step -> mask of every step it depends on, directly or not
+        self.descendants = None  # step -> mask of every step that depends on it
+        self.revalidate_mask = 0  # Steps that invalidate() clears downstream of an invalidated step
+
+    def register(self, number, name, handler, depends_on=(), retry_policy=None, timeout=None,
+                 on_exhausted="park", revalidate=True, rate_limit=None):
+        if number in self.steps:
+            raise ValueError(f"Step {number} is already registered as {self.steps[number].name}")
+        if any(step.name == name for step in self.steps.values()):
+            raise ValueError(f"Step name {name} is already registered")
+        if on_exhausted not in ("park", "skip"):
+            raise ValueError(f"Step {name}: on_exhausted must be park or skip, not {on_exhausted!r}")
+        self.steps[number] = Step(number, name, handler, depends_on, retry_policy, timeout, on_exhausted, revalidate,
+                                  rate_limit)
+        self.dispatch = None  # Needs compiling again
+        return handler
+
+    def step(self, number, name, depends_on=(), retry_policy=None, timeout=None, on_exhausted="park", revalidate=True,
+             rate_limit=None):
+        """Decorator form of register()."""
+        def decorator(handler):
+            return self.register(number, name, handler, depends_on, retry_policy, timeout, on_exhausted, revalidate,
+                                 rate_limit)
+        return decorator
+
+    def batch(self, number):
+        """Decorator registering a batch handler for step `number`."""
+        def decorator(handler):
+            self.batch_handlers[number] = handler
+            return handler
+        return decorator
+
+    def compile(self):
+        """Validate the steps and build the dispatch table and dependency graph."""
+        numbers = sorted(self.steps)
+        if numbers != list(range(1, len(numbers) + 1)):
+            raise ValueError(f"Steps must be numbered 1..n, got {numbers}")
+        for number in self.batch_handlers:
+            if number not in self.steps:
+                raise ValueError(f"Batch handler for unknown step {number}")
+        by_name = {step.name: number for number, step in self.steps.items()}
+
+        dependencies = [()]  # Index 0 is unused so step numbers index directly
+        for number in numbers:
+            resolved = []
+            for dep in self.steps[number].depends_on:
+                dep = by_name.get(dep, dep)
+                if dep not in self.steps:
+                    raise ValueError(f"Step {number} depends on unknown step {dep}")
+                resolved.append(dep)
+            dependencies.append(tuple(sorted(set(resolved))))
+
+        # Kahn's algorithm: any step left over is part of a cycle
+        remaining = {number: set(dependencies[number]) for number in numbers}
+        order = []
+        ready = [number for number in numbers if not remaining[number]]
+        while ready:
+            number = ready.pop(0)
+            order.append(number)
+            for other in numbers:
+                if number in remaining[other]:
+                    remaining[other].discard(number)
+                    if not remaining[other]:
+                        ready.append(other)
+        if len(order) != len(numbers):
+            cycle = sorted(set(numbers) - set(order))
+            raise ValueError(f"Dependency cycle among steps {cycle}")
+
+        # Closures in topological order: a step's ancestors are its dependencies plus theirs
+        ancestors = [0] * (len(numbers) + 1)
+        for number in order:
+            for dep in dependencies[number]:
+                ancestors[number] |= ancestors[dep] | self.bit(dep)
+        descendants = [0] * (len(numbers) + 1)
+        for number in numbers:
+            for other in numbers:
+                if ancestors[number] & self.bit(other):
+                    descendants[other] |= self.bit(number)
+
+        self.install({
+            "dependencies": dependencies,
+            "order": order,
+            "ancestors": ancestors,
+            "descendants": descendants,
+            "revalidate_mask": self.mask_of(number for number in numbers if self.steps[number].revalidate),
+        })
+        return self
+
+    def graph(self):
+        """Return what compile() worked out, as plain data (lists and ints)."""
+        return {
+            "dependencies": [list(deps) for deps in self.dependencies],
+            "order": list(self.order),
+            "ancestors": list(self.ancestors),
+            "descendants": list(self.descendants),
+            "revalidate_mask": self.revalidate_mask,
+        }
+
+    def install(self, graph):
+        """Take a graph() of the same steps instead of compiling, and build the dispatch table."""
+        self.dependencies = [tuple(deps) for deps in graph["dependencies"]]
+        self.order = tuple(graph["order"])
+        self.ancestors = list(graph["ancestors"])
+        self.descendants = list(graph["descendants"])
+        self.revalidate_mask = graph["revalidate_mask"]
+        self.dispatch = [None] + [self.steps[number].handler for number in sorted(self.steps)]
+        return self
+
+    @staticmethod
+    def bit(step):
+        return 1 << (step - 1)
+
+    def mask_of(self, steps):
+        mask = 0
+        for step in steps:
+            mask |= self.bit(step)
+        return mask
+
+    def steps_in(self, mask):
+        """Return the steps whose bits are set in mask, in dependency order."""
+        return [step for step in self.order if mask & self.bit(step)]
+
+    def retry_set(self, step, completed_mask):
+        """Mask of the steps to run so `step` can be retried: it and its unfinished dependencies."""
+        return (self.ancestors[step] | self.bit(step)) & ~completed_mask
+
+    def invalidate(self, step, completed_mask):
+        """Clear step and everything downstream of it from completed_mask, except steps registered with revalidate=False."""
+        return completed_mask & ~(self.bit(step) | self.descendants[step] & self.revalidate_mask)
+
+    def ready(self, done_mask):
+        """Return the steps not in done_mask whose dependencies all are, in dependency order."""
+        return [step for step in self.order if not done_mask & self.bit(step) and not self.ancestors[step] & ~done_mask]
+
+    @staticmethod
+    def first_pending(done_mask):
+        """Return the lowest step number not in done_mask; max_steps + 1 once every step is."""
+        return ((done_mask + 1) & ~done_mask).bit_length()
+
+    def number_of(self, step):
+        """Return a step's number, given its number or its name."""
+        for number, registered in self.steps.items():
+            if step in (number, registered.name, str(number)):
+                return number
+        raise ValueError(f"Unknown step {step!r}")
+
+    @property
+    def max_steps(self):
+        return len(self.steps)
+
+    def process_step(self, step):
+        """Run the handler for a step number. Unknown steps return False."""
+        if 0 < step < len(self.dispatch):
+            return self.dispatch[step]()
+        return False
+
+    def batchable(self, step):
+        return step in self.batch_handlers
+
+    def process_step_batch(self, step, order_ids):
+        """Run a step for many orders. Returns one result per order, exceptions included.
+
+        Steps without a batch handler are run once per order.
+        """
+        handler = self.batch_handlers.get(step)
+        if handler is not None:
+            results = list(handler(order_ids))
+            if len(results) != len(order_ids):
+                raise ValueError(f"Batch handler for step {step} returned {len(results)} results "
+                                 f"for {len(order_ids)} orders")
+            return results
+        results = []
+        for _ in order_ids:
+            try:
+                results.append(self.process_step(step))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def get_dependencies(self, step):
+        """Return the steps a step depends on directly."""
+        if 0 < step < len(self.dependencies):
+            return list(self.dependencies[step])
+        return []
+
+    def name_of(self, step):
+        return self.steps[step].name if step in self.steps else f"step {step}"
+
+    def on_exhausted(self, step):
+        """What runners do with an order once a step's retries run out: "park" or "skip"."""
+        return self.steps[step].on_exhausted if step in self.steps else "park"
+
+    def timeout_for(self, step, default=None):
+        timeout = self.steps[step].timeout if step in self.steps else None
+        return default if timeout is None else timeout
+
+    def retry_policies(self):
+        """Return {step: policy} for the steps that declared their own retry policy."""
+        return {number: step.retry_policy for number, step in self.steps.items() if step.retry_policy is not None}
+
+    def rate_limits(self):
+        """Return {step: RateLimit} for the steps that declared one."""
+        return {number: step.rate_limit for number, step in self.steps.items() if step.rate_limit is not None}
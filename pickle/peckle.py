@@ -1,23 +1,32 @@
-import pickle
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import parking
 import time
+from checkpoint import CheckpointPolicy, exit_on_signals
+
+MAX_STEPS = 5
 
 # Functions to persist state
-def save_state(data, filename="state.pkl"):
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+def open_state_store(filename="state.pkl"):
+    return state_store.open_store(filename, max_steps=MAX_STEPS)
 
 def load_state(filename="state.pkl"):
-    try:
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return None
+    return open_state_store(filename).load()
+
+parking_lot = parking.ParkingLot()
 
 # Task class with manual resolution
 class TaskWithManualResolution:
-    def __init__(self):
+    def __init__(self, unattended=False, checkpoint="step"):
         self.state = load_state() or {"step": 1}  # Load state or start from step 1
-        self.max_steps = 5
+        self.max_steps = MAX_STEPS
+        self.unattended = unattended  # Park failed orders instead of prompting
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, open_state_store())
+
+    def save_state(self):
+        self.checkpoint.save(self.state)
 
     def run_step(self, step_number):
         """Simulate a task that can fail."""
@@ -30,7 +39,31 @@ class TaskWithManualResolution:
 
         return True  # Indicate successful execution
 
+    def park(self, error):
+        """Park the order for an operator instead of blocking on input()."""
+        parking_lot.park(state_store.DEFAULT_ORDER, self.state["step"], error, self.state)
+        self.save_state()
+        self.checkpoint.flush()
+        print(f"Error: {error}. Order parked at Step {self.state['step']}; "
+              f"release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' and run again.")
+
+    def is_parked(self):
+        if self.unattended and parking_lot.is_parked(state_store.DEFAULT_ORDER):
+            print(f"Order is parked; release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' first.")
+            return True
+        if parking_lot.resume(self.state):
+            self.save_state()  # Released by an operator; retries start afresh
+        return False
+
     def run(self):
+        if self.is_parked():
+            return
+        try:
+            self.process()
+        finally:
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+
+    def process(self):
         while self.state["step"] <= self.max_steps:
             try:
                 print(f"Starting step {self.state['step']}...")
@@ -39,10 +72,14 @@ class TaskWithManualResolution:
                 # If the step succeeds, update the state and save
                 if success:
                     self.state["step"] += 1
-                    save_state(self.state)
+                    self.save_state()
 
             except Exception as e:
+                if self.unattended:
+                    self.park(e)
+                    return
                 print(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.checkpoint.flush()  # Don't leave progress uncommitted while waiting on the operator
                 input("Press Enter to resume...")  # Wait for user to press Enter
                 continue  # Continue to retry the current step
 
@@ -50,5 +87,14 @@ class TaskWithManualResolution:
 
 # Example usage
 if __name__ == "__main__":
-    task = TaskWithManualResolution()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unattended", action="store_true", help="park the order on failure instead of prompting")
+    parser.add_argument("--checkpoint", default="step",
+                        help="when to commit state: step (default), N transitions, Tms, exit, or e.g. 10,250ms")
+    args = parser.parse_args()
+
+    exit_on_signals()
+    task = TaskWithManualResolution(args.unattended, args.checkpoint)
     task.run()
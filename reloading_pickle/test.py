@@ -1,38 +1,72 @@
-import pickle
-import time
+import os
 import sys
-import importlib
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import parking
+import time
+import hot_reload
 import task_logic  # Import the task logic module
+from checkpoint import CheckpointPolicy, exit_on_signals
+from retry_policy import RetryPolicies
+
+MAX_STEPS = 5
 
-def save_state(data, filename="state.pkl"):
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+def open_state_store(filename="state.pkl"):
+    return state_store.open_store(filename, max_steps=MAX_STEPS)
 
 def load_state(filename="state.pkl"):
-    try:
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return None
+    return open_state_store(filename).load()
+
+logic_reloader = hot_reload.ModuleReloader("task_logic")
+parking_lot = parking.ParkingLot()
 
 class TaskWithDynamicReload:
-    def __init__(self):
+    def __init__(self, unattended=False, checkpoint="step", retry_policies=None):
         self.state = load_state() or {"step": 1, "retry_count": 0}
-        self.max_steps = 5
-        self.max_retries = 3
+        self.max_steps = MAX_STEPS
+        self.retry_policies = retry_policies or RetryPolicies()  # The defaults for every step
+        self.unattended = unattended  # Park failed orders instead of prompting
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, open_state_store())
+
+    def save_state(self):
+        self.checkpoint.save(self.state)
+
+    def max_retries(self, step):
+        return self.retry_policies.policy_for(step).max_retries
 
     def reload_task_logic(self):
-        """Dynamically reload the task_logic module."""
-        if "task_logic" in sys.modules:
-            del sys.modules["task_logic"]  # Remove from cache
+        """Reload the task_logic module if its source changed."""
         global task_logic
-        importlib.import_module("task_logic")  # Reimport fresh module
-        task_logic = sys.modules["task_logic"]  # Update the reference
+        task_logic = logic_reloader.load()
+
+    def park(self, error):
+        """Park the order for an operator instead of blocking on input()."""
+        parking_lot.park(state_store.DEFAULT_ORDER, self.state["step"], error, self.state)
+        self.save_state()
+        self.checkpoint.flush()
+        print(f"Error: {error}. Order parked at Step {self.state['step']}; "
+              f"release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' and run again.")
+
+    def is_parked(self):
+        if self.unattended and parking_lot.is_parked(state_store.DEFAULT_ORDER):
+            print(f"Order is parked; release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' first.")
+            return True
+        if parking_lot.resume(self.state):
+            self.save_state()  # Released by an operator; retries start afresh
+        return False
 
     def run(self):
+        if self.is_parked():
+            return
+        try:
+            self.process()
+        finally:
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+
+    def process(self):
         while self.state["step"] <= self.max_steps:
             try:
-                print(f"Starting step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries})...")
+                print(f"Starting step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries(self.state['step'])})...")
                 self.reload_task_logic()  # Reload the task logic dynamically
 
                 # Run the task logic for the current step
@@ -41,23 +75,36 @@ class TaskWithDynamicReload:
                 if success:
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
-                    save_state(self.state)
+                    self.save_state()
 
             except Exception as e:
+                if self.unattended:
+                    self.park(e)
+                    return
                 print(f"Error: {e}. Resolve the issue and press Enter to continue.")
+                self.checkpoint.flush()  # Don't leave progress uncommitted while waiting on the operator
                 input("Press Enter to resume...")
                 self.state["retry_count"] += 1
 
-                if self.state["retry_count"] > self.max_retries:
+                if self.state["retry_count"] > self.max_retries(self.state["step"]):
                     print("Maximum retries reached. Skipping to the next step.")
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
 
-                save_state(self.state)
+                self.save_state()
                 continue
 
         print("Task completed successfully!")
 
 if __name__ == "__main__":
-    task = TaskWithDynamicReload()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unattended", action="store_true", help="park the order on failure instead of prompting")
+    parser.add_argument("--checkpoint", default="step",
+                        help="when to commit state: step (default), N transitions, Tms, exit, or e.g. 10,250ms")
+    args = parser.parse_args()
+
+    exit_on_signals()
+    task = TaskWithDynamicReload(args.unattended, args.checkpoint)
     task.run()
@@ -1,112 +1,186 @@
-import pickle
+import os
 import sys
-import importlib
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))  # Modules the runners share
+import state_store
+import metrics
+import parking
+import hot_reload
+import step_cache
 import order_processing_logic  # Import the order processing logic module
+from order_record import OrderRecord
+from checkpoint import CheckpointPolicy, exit_on_signals
+from retry_policy import RetryPolicies
 
 
-def save_state(data, filename="order_state.pkl"):
-    """Save the current processing state to a Pickle file."""
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+def open_state_store(filename="order_state.pkl"):
+    return state_store.open_store(filename, max_steps=order_processing_logic.registry.max_steps)
 
 
 def load_state(filename="order_state.pkl"):
-    """Load the saved processing state from a Pickle file."""
-    try:
-        with open(filename, "rb") as f:
-            return pickle.load(f)
-    except FileNotFoundError:
-        return None
+    """Load the saved processing state from the state store."""
+    return open_state_store(filename).load()
+
+
+logic_reloader = hot_reload.ModuleReloader("order_processing_logic")
+parking_lot = parking.ParkingLot()
+log = metrics.get_logger("rerun")
+result_cache = step_cache.StepCache(filename="step_results")
 
 
 class OrderProcessingWithRetry:
-    def __init__(self):
-        self.state = load_state() or {"step": 1, "retry_count": 0, "completed_steps": []}
-        self.max_steps = 5
-        self.max_retries = 3
+    def __init__(self, unattended=False, force=False, checkpoint="step", retry_policies=None):
+        self.state = load_state() or OrderRecord()
+        self.max_steps = order_processing_logic.registry.max_steps
+        self.retry_policies = retry_policies or RetryPolicies(per_step=order_processing_logic.registry.retry_policies())
+        self.unattended = unattended  # Park failed orders instead of prompting
+        self.force = force  # Re-run steps even when the result cache has them
+        self.checkpoint = CheckpointPolicy.parse(checkpoint, open_state_store())
+
+    def save_state(self):
+        self.checkpoint.save(self.state)
+
+    def max_retries(self, step):
+        return self.retry_policies.policy_for(step).max_retries
 
     def reload_task_logic(self):
-        """Dynamically reload the order_processing_logic module."""
-        if "order_processing_logic" in sys.modules:
-            del sys.modules["order_processing_logic"]  # Remove from cache
+        """Reload the order_processing_logic module if its source changed."""
         global order_processing_logic
-        importlib.import_module("order_processing_logic")  # Reimport fresh module
-        order_processing_logic = sys.modules["order_processing_logic"]  # Update the reference
+        with metrics.registry.timer("logic_reload_seconds"):
+            order_processing_logic = logic_reloader.load()
+        self.max_steps = order_processing_logic.registry.max_steps
+
+    def completed_steps(self):
+        return order_processing_logic.registry.steps_in(self.state["completed_mask"])
+
+    def is_completed(self, step):
+        return bool(self.state["completed_mask"] & order_processing_logic.registry.bit(step))
+
+    def cache_key(self, step):
+        """Result cache key: the step's upstream progress and the logic it runs."""
+        registry = order_processing_logic.registry
+        inputs = step_cache.input_hash(step, self.state["completed_mask"] & registry.ancestors[step])
+        return result_cache.key(state_store.DEFAULT_ORDER, step, inputs, logic_reloader.digest)
+
+    def ask_steps_to_rerun(self):
+        """Prompt for completed steps to re-run. Returns an empty list to skip."""
+        self.checkpoint.flush()  # Don't leave progress uncommitted while waiting on the operator
+        rerun_steps = input(
+            f"Enter step numbers to re-run from completed steps {self.completed_steps()} (comma-separated), or press Enter to skip: "
+        ).strip()
+        if rerun_steps:
+            try:
+                return [int(s.strip()) for s in rerun_steps.split(",")]
+            except ValueError:
+                log.warning("Invalid input. Please enter step numbers as comma-separated values.")
+        return []
 
     def rerun_steps(self, steps_to_rerun):
-        """Recursively re-run selected steps."""
-        for step_to_rerun in steps_to_rerun:
-            if step_to_rerun in self.state["completed_steps"]:
-                print(f"Re-running Step {step_to_rerun}...")
+        """Re-run selected steps, asking for a new selection whenever a re-run fails."""
+        while steps_to_rerun:
+            steps, steps_to_rerun = steps_to_rerun, []
+            for step_to_rerun in steps:
+                if not self.is_completed(step_to_rerun):
+                    log.info(f"Step {step_to_rerun} is not in the completed steps.")
+                    continue
+
                 self.reload_task_logic()  # Reload the logic dynamically
+                if not self.force and result_cache.get(self.cache_key(step_to_rerun)) is not step_cache.MISS:
+                    log.info(f"Step {step_to_rerun} is unchanged since it last succeeded; using the cached result.")
+                    continue
+
+                log.info(f"Re-running Step {step_to_rerun}...")
                 try:
-                    success = order_processing_logic.process_step(step_to_rerun)
-                    if success:
-                        print(f"Step {step_to_rerun} re-executed successfully!")
+                    with metrics.registry.timer("step_latency_seconds", step=step_to_rerun):
+                        success = order_processing_logic.process_step(step_to_rerun)
                 except Exception as e:
-                    print(f"Error during re-run of Step {step_to_rerun}: {e}")
-                    # Recursive prompt for retrying failed re-run
-                    new_rerun_steps = input(
-                        f"Enter step numbers to re-run from completed steps {self.state['completed_steps']} (comma-separated), or press Enter to skip: "
-                    ).strip()
-                    if new_rerun_steps:
-                        try:
-                            steps = [int(s.strip()) for s in new_rerun_steps.split(",")]
-                            self.rerun_steps(steps)  # Recursive call
-                        except ValueError:
-                            print("Invalid input. Please enter step numbers as comma-separated values.")
-                    return  # Exit after handling the failure
-
-            else:
-                print(f"Step {step_to_rerun} is not in the completed steps.")
+                    log.error(f"Error during re-run of Step {step_to_rerun}: {e}")
+                    if not self.unattended:
+                        steps_to_rerun = self.ask_steps_to_rerun()  # Prompt again instead of recursing
+                    break  # Stop this round after handling the failure
+                if success:
+                    result_cache.put(self.cache_key(step_to_rerun), success)
+                    log.info(f"Step {step_to_rerun} re-executed successfully!")
+
+    def park(self, error):
+        """Park the order for an operator instead of blocking on input()."""
+        parking_lot.park(state_store.DEFAULT_ORDER, self.state["step"], error, self.state)
+        self.save_state()
+        self.checkpoint.flush()
+        log.error(f"Error: {error}. Order parked at Step {self.state['step']}; "
+                  f"release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' and run again.")
+
+    def is_parked(self):
+        if self.unattended and parking_lot.is_parked(state_store.DEFAULT_ORDER):
+            log.warning(f"Order is parked; release it with 'python ../common/parking.py release {state_store.DEFAULT_ORDER}' first.")
+            return True
+        if parking_lot.resume(self.state):
+            self.save_state()  # Released by an operator; retries start afresh
+        return False
 
     def run(self):
+        if self.is_parked():
+            return
+        try:
+            self.process()
+        finally:
+            self.checkpoint.close()  # Commits whatever the policy has not, however the run ends
+
+    def process(self):
         while self.state["step"] <= self.max_steps:
             try:
-                if self.state["step"] in self.state["completed_steps"]:
-                    print(f"Step {self.state['step']} already completed. Skipping...")
+                if self.is_completed(self.state["step"]):
+                    log.info(f"Step {self.state['step']} already completed. Skipping...")
                     self.state["step"] += 1
-                    save_state(self.state)
+                    self.save_state()
                     continue
 
-                print(f"Processing Step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries})...")
+                log.info(f"Processing Step {self.state['step']} (Retry {self.state['retry_count']} of {self.max_retries(self.state['step'])})...")
                 self.reload_task_logic()  # Reload the task logic dynamically
 
                 # Run the task logic for the current step
-                success = order_processing_logic.process_step(self.state["step"])
-
-                if success:
-                    self.state["completed_steps"].append(self.state["step"])
-                    self.state["step"] += 1
-                    self.state["retry_count"] = 0
-                    save_state(self.state)
-                    print(f"Step {self.state['step'] - 1} completed successfully!")
+                with metrics.registry.timer("step_latency_seconds", step=self.state["step"]):
+                    success = order_processing_logic.process_step(self.state["step"])
 
             except Exception as e:
-                print(f"Error: {e}. You can re-run any previous steps or press Enter to continue.")
-                rerun_steps = input(
-                    f"Enter step numbers to re-run from completed steps {self.state['completed_steps']} (comma-separated), or press Enter to skip: "
-                ).strip()
-
-                if rerun_steps:
-                    try:
-                        steps_to_rerun = [int(s.strip()) for s in rerun_steps.split(",")]
-                        self.rerun_steps(steps_to_rerun)  # Handle re-runs
-                    except ValueError:
-                        print("Invalid input. Please enter step numbers as comma-separated values.")
+                if self.unattended:
+                    self.park(e)
+                    return
+                log.error(f"Error: {e}. You can re-run any previous steps or press Enter to continue.")
+                self.rerun_steps(self.ask_steps_to_rerun())  # Handle re-runs
 
                 self.state["retry_count"] += 1
-                if self.state["retry_count"] > self.max_retries:
-                    print(f"Maximum retries reached for Step {self.state['step']}. Skipping to the next step.")
+                metrics.registry.counter("step_retries_total", step=self.state["step"]).inc()
+                if self.state["retry_count"] > self.max_retries(self.state["step"]):
+                    log.warning(f"Maximum retries reached for Step {self.state['step']}. Skipping to the next step.")
                     self.state["step"] += 1
                     self.state["retry_count"] = 0
 
-                save_state(self.state)
+                self.save_state()
                 continue
 
-        print("Order processing completed successfully!")
+            # Only a failing step counts as a failure, not recording its result
+            if success:
+                result_cache.put(self.cache_key(self.state["step"]), success)
+                self.state["completed_mask"] |= order_processing_logic.registry.bit(self.state["step"])
+                self.state["step"] += 1
+                self.state["retry_count"] = 0
+                self.save_state()
+                log.info(f"Step {self.state['step'] - 1} completed successfully!")
+
+        metrics.registry.counter("orders_completed_total").inc()
+        log.info("Order processing completed successfully!")
 
 
 if __name__ == "__main__":
-    order_processor = OrderProcessingWithRetry()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unattended", action="store_true", help="park the order on failure instead of prompting")
+    parser.add_argument("--force", action="store_true", help="re-run steps even if their results are cached")
+    parser.add_argument("--checkpoint", default="step",
+                        help="when to commit state: step (default), N transitions, Tms, exit, or e.g. 10,250ms")
+    args = parser.parse_args()
+
+    exit_on_signals()
+    order_processor = OrderProcessingWithRetry(args.unattended, args.force, args.checkpoint)
     order_processor.run()